@@ -0,0 +1,271 @@
+import json
+import re
+import struct
+from argparse import ArgumentParser
+from base64 import b64encode
+from collections import Counter
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+__all__ = [
+    'FakeCAServer',
+]
+
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+_CONDITION = re.compile(r'\{\s*([\w.]+)\s+(eq|gt)\s+(.*?)\s*\}')
+
+
+class FakeCAState(object):
+    """
+    Данные подставного СА в памяти и счетчики обращений к нему.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.tables = {}
+            self.ids = count(1)
+            self.requests = Counter()
+            self.websocket_frames = 0
+            self.websocket_events = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': sum(self.requests.values()),
+                'by_endpoint': {
+                    f'{method} {endpoint}': number
+                    for (method, endpoint), number
+                    in sorted(self.requests.items())
+                },
+                'websocket_frames': self.websocket_frames,
+                'websocket_events': self.websocket_events,
+                'rows': {
+                    table: len(rows) for table, rows in self.tables.items()
+                },
+            }
+
+    def _field(self, row, column):
+        # entity_batch.order_id -> order_id строки entity_batch,
+        # на которую ссылается row['entity_batch_id']
+        if '.' not in column:
+            return row.get(column)
+        relation, column = column.split('.', 1)
+        related_id = row.get(f'{relation}_id')
+        for related in self.tables.get(relation, []):
+            if related['id'] == related_id:
+                return self._field(related, column)
+        return None
+
+    def _matches(self, row, conditions, join_with_or):
+        results = []
+        for column, operator, value in conditions:
+            field = self._field(row, column)
+            if operator == 'eq':
+                results.append(str(field) == value)
+            else:
+                results.append(field is not None and field > int(value))
+        return any(results) if join_with_or else all(results)
+
+    def select(self, table, query):
+        with self.lock:
+            rows = self.tables.get(table, [])
+            filter_query = query.get('filter', [''])[0]
+            conditions = _CONDITION.findall(filter_query)
+            if conditions:
+                join_with_or = ' or ' in filter_query
+                rows = [
+                    row for row in rows
+                    if self._matches(row, conditions, join_with_or)
+                ]
+            total = len(rows)
+            if 'start' in query:
+                start = int(query['start'][0])
+                rows = rows[start:int(query.get('stop', [total])[0])]
+            response = {'meta': {'count': total}}
+            if rows:
+                response[table] = rows
+            for relation in query.get('with', []):
+                if '.' in relation:
+                    continue
+                related_ids = {row.get(f'{relation}_id') for row in rows}
+                response[relation] = [
+                    related for related in self.tables.get(relation, [])
+                    if related['id'] in related_ids
+                ]
+            return response
+
+    def insert(self, table, rows):
+        with self.lock:
+            created = []
+            for row in rows:
+                row = dict(row, id=next(self.ids))
+                self.tables.setdefault(table, []).append(row)
+                created.append(row)
+            return {table: created}
+
+
+class FakeCAHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # заголовки и тело пишутся отдельно, без этого каждый ответ
+    # ждет delayed ACK клиента
+    disable_nagle_algorithm = True
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        return json.loads(body) if body else {}
+
+    def _count(self, method, path):
+        endpoint = re.sub(r'^/(rest/collection|rest)/\w+',
+                          lambda match: match.group(1) + '/{model}',
+                          path)
+        with self.state.lock:
+            self.state.requests[(method, endpoint.lstrip('/'))] += 1
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path.replace('//', '/')
+        if path == '/_stats':
+            return self._send_json(self.state.stats())
+        if path == '/message' and \
+                self.headers.get('Upgrade', '').lower() == 'websocket':
+            return self._serve_websocket()
+        self._count('GET', path)
+        sleep(self.state.latency)
+        if path.startswith('/rest/collection/'):
+            table = path[len('/rest/collection/'):]
+            return self._send_json(
+                self.state.select(table, parse_qs(url.query))
+            )
+        return self._send_json({'data': {}})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        path = url.path.replace('//', '/')
+        data = self._read_json()
+        if path == '/_reset':
+            self.state.reset()
+            return self._send_json({})
+        self._count('POST', path)
+        sleep(self.state.latency)
+        if path.startswith('/rest/'):
+            table = path[len('/rest/'):]
+            return self._send_json(self.state.insert(table, data[table]))
+        return self._send_json({'data': {}})
+
+    def _serve_websocket(self):
+        accept = b64encode(sha1(
+            (self.headers['Sec-WebSocket-Key'] + _WEBSOCKET_GUID).encode()
+        ).digest()).decode()
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        while True:
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                break
+            opcode = header[0] & 0x0f
+            length = header[1] & 0x7f
+            if length == 126:
+                length, = struct.unpack('>H', self.rfile.read(2))
+            elif length == 127:
+                length, = struct.unpack('>Q', self.rfile.read(8))
+            mask = self.rfile.read(4) if header[1] & 0x80 else b'\0' * 4
+            payload = bytes(
+                byte ^ mask[i % 4]
+                for i, byte in enumerate(self.rfile.read(length))
+            )
+            if opcode == 0x8:
+                self.wfile.write(b'\x88\x00')
+                break
+            if opcode == 0x1:
+                message = json.loads(payload)
+                with self.state.lock:
+                    self.state.websocket_frames += 1
+                    self.state.websocket_events += len(message['data'])
+        self.close_connection = True
+
+
+class FakeCAServer(object):
+    """
+    Подставной СА для замеров: реализует rest/collection/*, rest/{model},
+    action/* и websocket /message, каждый запрос задерживается на latency
+    секунд. /_stats отдает счетчики, POST /_reset очищает данные.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self._server = ThreadingHTTPServer((host, port), FakeCAHandler)
+        self._server.daemon_threads = True
+        self._server.state = FakeCAState(latency)
+        self._thread = None
+
+    @property
+    def state(self):
+        return self._server.state
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    @property
+    def ws_url(self):
+        host, port = self._server.server_address[:2]
+        return f'ws://{host}:{port}'
+
+    def __enter__(self):
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--host', required=False, default='127.0.0.1')
+    parser.add_argument('-p', '--port', required=False, type=int,
+                        default=8080)
+    parser.add_argument('-l', '--latency', required=False, type=float,
+                        default=0.0)
+    args = parser.parse_args()
+
+    server = FakeCAServer(args.host, args.port, args.latency)
+    print(f'Подставной СА: {server.url}, websocket: {server.ws_url}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
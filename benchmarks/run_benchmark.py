@@ -0,0 +1,194 @@
+import asyncio
+import json
+import multiprocessing
+from argparse import ArgumentParser
+from os import getcwd
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.fake_ca_server import FakeCAServer
+from benchmarks.synthetic_workbook import make_workbook
+from logic.async_import_data_to_ca import start_batches_async
+from logic.import_data_to_ca import start_batches
+from main import read_input_data
+from utils.async_carest import AsyncCARest
+from utils.carest import CARest
+from utils.request_metrics import RequestMetrics
+from utils.yml_config import read_config
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MODES = ('row', 'bulk', 'parallel', 'async')
+
+
+class _RowByRowCARest(CARest):
+    """
+    CARest без массовой загрузки, как до нее: справочники заранее не
+    читаются, каждый объект ищется GET и создается POST по одному.
+    Повторы одного объекта за запуск по-прежнему снимает ObjectMemo.
+    """
+
+    def load_index(self, model):
+        return {}
+
+    def create_objects(self, model, rows, **kwargs):
+        check_value = self._check_column(model)
+        return {
+            row[check_value]: self.create_object(model, row) for row in rows
+        }
+
+
+def _peak_memory_mb():
+    if resource is None:
+        return None
+    # ru_maxrss в Linux измеряется в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_mode(mode, workbook_path, columns, ca_config, workers, results):
+    started = perf_counter()
+    data = read_input_data(workbook_path, columns)
+    read_seconds = perf_counter() - started
+
+    if mode == 'async':
+        async def run():
+            async with AsyncCARest.from_config(ca_config) as session:
+                await session._perform_login()
+                await start_batches_async(session, data)
+
+        asyncio.run(run())
+    else:
+        session_class = _RowByRowCARest if mode == 'row' else CARest
+        metrics = RequestMetrics()
+
+        def make_session():
+            worker_session = session_class.from_config(
+                ca_config, metrics=metrics
+            )
+            worker_session._perform_login()
+            return worker_session
+
+        with session_class.from_config(
+                ca_config, metrics=metrics
+        ) as session:
+            session._perform_login()
+            start_batches(
+                session,
+                data,
+                workers=workers if mode == 'parallel' else 1,
+                session_factory=make_session
+            )
+
+    results.put({
+        'mode': mode,
+        'wall_seconds': round(perf_counter() - started, 3),
+        'read_seconds': round(read_seconds, 3),
+        'peak_memory_mb': _peak_memory_mb(),
+    })
+
+
+def run_benchmark(workbook_path, columns, modes=MODES, latency=0.0,
+                  workers=8):
+    """
+    Запускает импорт книги в каждом режиме на подставном СА и возвращает
+    время, число запросов и пиковую память. Каждый режим выполняется
+    в отдельном процессе на пустом СА.
+    """
+    context = multiprocessing.get_context('spawn')
+    report = []
+    with FakeCAServer(latency=latency) as server:
+        ca_config = {
+            'url': server.url,
+            'ws_url': server.ws_url,
+            'login': 'benchmark',
+            'password': 'benchmark',
+            'verify': False,
+        }
+        for mode in modes:
+            server.state.reset()
+            results = context.Queue()
+            process = context.Process(
+                target=_run_mode,
+                args=(mode, workbook_path, columns, ca_config, workers,
+                      results)
+            )
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                report.append({'mode': mode, 'error': process.exitcode})
+                continue
+            result = results.get()
+            stats = server.state.stats()
+            result['requests'] = stats['requests']
+            result['requests_per_second'] = round(
+                stats['requests'] / result['wall_seconds'], 1
+            )
+            result['websocket_frames'] = stats['websocket_frames']
+            result['websocket_events'] = stats['websocket_events']
+            result['by_endpoint'] = stats['by_endpoint']
+            report.append(result)
+    return report
+
+
+def print_report(report):
+    columns = ('mode', 'wall_seconds', 'read_seconds', 'requests',
+               'requests_per_second', 'websocket_frames', 'peak_memory_mb')
+    print(' | '.join(columns))
+    for result in report:
+        print(' | '.join(str(result.get(column, '')) for column in columns))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config', required=False,
+                        default=join(getcwd(), 'config.yml'))
+    parser.add_argument('-f', '--file', required=False, default=None)
+    parser.add_argument('-b', '--batches', required=False, type=int,
+                        default=200)
+    parser.add_argument('-o', '--operations', required=False, type=int,
+                        default=10)
+    parser.add_argument('--bom-depth', required=False, type=int, default=2)
+    parser.add_argument('-r', '--routes', required=False, type=int,
+                        default=10)
+    parser.add_argument('-l', '--latency', required=False, type=float,
+                        default=0.005)
+    parser.add_argument('-w', '--workers', required=False, type=int,
+                        default=8)
+    parser.add_argument('-m', '--modes', required=False,
+                        default=','.join(MODES))
+    parser.add_argument('--json', required=False, default=None)
+    args = parser.parse_args()
+
+    columns = read_config(args.config)['columns']
+    with TemporaryDirectory() as temp_dir:
+        workbook_path = args.file
+        if workbook_path is None:
+            workbook_path = join(temp_dir, 'benchmark.xlsx')
+            make_workbook(
+                workbook_path,
+                columns,
+                batches=args.batches,
+                operations=args.operations,
+                bom_depth=args.bom_depth,
+                routes=args.routes
+            )
+        report = run_benchmark(
+            workbook_path,
+            columns,
+            modes=args.modes.split(','),
+            latency=args.latency,
+            workers=args.workers
+        )
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import openpyxl
+
+__all__ = [
+    'make_workbook',
+]
+
+
+def _bom_rows(product, depth, children):
+    # дерево спецификации: у каждой ДСЕ children дочерних до глубины depth
+    level = [product]
+    for level_number in range(1, depth + 1):
+        next_level = []
+        for parent in level:
+            for child_number in range(children):
+                child = f'{parent}.{child_number}'
+                next_level.append(child)
+                yield [parent, f'{parent} ид', f'{parent} наим',
+                       child, f'{child} ид', f'{child} наим', 1]
+        level = next_level
+
+
+def make_workbook(path, columns, batches=100, operations=10, bom_depth=2,
+                  routes=10, departments=5, equipment=20, bom_children=2):
+    """
+    Создает книгу с листами из config['columns']: batches партий по
+    routes маршрутам, по operations операций в маршруте и деревом
+    спецификации глубиной bom_depth на каждое изделие.
+    """
+    # изделие маршрута должно попасть в спецификацию, иначе для него
+    # не будет создана ДСЕ
+    bom_depth = max(1, bom_depth)
+    workbook = openpyxl.Workbook(write_only=True)
+
+    sheet = workbook.create_sheet(columns['departments'])
+    sheet.append(['DEPT_ID', 'NAME'])
+    for dept_id in range(1, departments + 1):
+        sheet.append([dept_id, f'Цех {dept_id}'])
+
+    sheet = workbook.create_sheet(columns['equipment'])
+    sheet.append(['ID', 'EQUIPMENT_ID', 'NAME'])
+    for equipment_id in range(1, equipment + 1):
+        sheet.append([equipment_id, equipment_id, f'Станок {equipment_id}'])
+
+    sheet = workbook.create_sheet(columns['routes'])
+    sheet.append(['ROUTE_ID', 'CODE'])
+    for route_id in range(1, routes + 1):
+        sheet.append([route_id, f'P{route_id}'])
+
+    sheet = workbook.create_sheet(columns['operations'])
+    sheet.append(['ID', 'ROUTE_ID', 'NAME', 'NORM_AMOUNT', 'NOP',
+                  'EQUIPMENT_ID', 'DEPT_ID'])
+    for route_id in range(1, routes + 1):
+        for operation_number in range(1, operations + 1):
+            sheet.append([
+                f'{route_id}_{operation_number}',
+                route_id,
+                f'Операция {operation_number}',
+                2.5,
+                str(operation_number * 5).zfill(3),
+                operation_number % equipment + 1,
+                operation_number % departments + 1,
+            ])
+
+    sheet = workbook.create_sheet(columns['bill_of_materials'])
+    sheet.append(['PARENT_CODE', 'PARENT_IDENTITY', 'PARENT_NAME',
+                  'CODE', 'IDENTITY', 'NAME', 'AMOUNT'])
+    for route_id in range(1, routes + 1):
+        for row in _bom_rows(f'P{route_id}', bom_depth, bom_children):
+            sheet.append(row)
+
+    sheet = workbook.create_sheet(columns['batches'])
+    sheet.append(['BATCH_ID', 'ROUTE_ID', 'AMOUNT', 'DATE_TO'])
+    date_to = datetime.now().replace(microsecond=0) + timedelta(days=7)
+    for batch_id in range(1, batches + 1):
+        sheet.append([batch_id, batch_id % routes + 1, 1, date_to])
+
+    workbook.save(path)
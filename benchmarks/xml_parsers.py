@@ -0,0 +1,188 @@
+import tracemalloc
+from argparse import ArgumentParser
+from io import BytesIO
+from time import perf_counter
+
+from utils.entity_routes import ReadSession
+from utils.read_from_ftp import KKFtpReader
+
+__all__ = [
+    'make_material_document',
+    'make_movement_document',
+    'run_xml_benchmark',
+]
+
+_MOVEMENT_ITEM = (
+    '<Items><BWART>{bwart}</BWART><UMLGO>{umlgo}</UMLGO>'
+    '<LGORT>{lgort}</LGORT><UMMAT>M{material}</UMMAT>'
+    '<MATNR>N{material}</MATNR><ERFMG>{quantity}</ERFMG>'
+    '<SGTXT>{padding}</SGTXT></Items>'
+)
+_BOM_ITEM = (
+    '<BOMITEM><ISSUE_LOC>1072</ISSUE_LOC><ITEM_CATEG>{category}</ITEM_CATEG>'
+    '<COMPONENT>C{component}</COMPONENT><COMP_QTY>{quantity}</COMP_QTY>'
+    '<POTX1>{padding}</POTX1></BOMITEM>'
+)
+_ROUTING_OPERATION = (
+    '<ROUTINGOPERATION><VORNR>{nop:04d}</VORNR>'
+    '<LTXA1>Операция {nop}</LTXA1><VGW01>1.5</VGW01><VGW03>{labor}</VGW03>'
+    '<BMSCH>1</BMSCH><VGW06>100</VGW06><ARBID>{equipment}</ARBID>'
+    '<LTXA2>{padding}</LTXA2></ROUTINGOPERATION>'
+)
+
+
+def make_movement_document(items, padding=50):
+    """
+    Документ движения материалов с items позициями Items, как body
+    из каталога запросов.
+    """
+    parts = ['<?xml version="1.0" encoding="utf-8"?><Document>'
+             '<Header><MBLNR>4900000001</MBLNR></Header>']
+    for number in range(items):
+        parts.append(_MOVEMENT_ITEM.format(
+            bwart=('301', '311', '101')[number % 3],
+            umlgo='1072' if number % 2 == 0 else '1010',
+            lgort='1072' if number % 4 == 1 else '1020',
+            material=number % 100,
+            quantity=f'{number % 7}.5' + ('-' if number % 10 == 0 else ''),
+            padding='x' * padding
+        ))
+    parts.append('</Document>')
+    return ''.join(parts).encode('utf-8')
+
+
+def make_material_document(bom_items, operations, padding=50):
+    """
+    Документ материала со спецификацией из bom_items позиций и
+    маршрутом из operations операций.
+    """
+    parts = ['<?xml version="1.0" encoding="utf-8"?><Material>'
+             '<MATERIALDATA><MATNR>1000</MATNR><MEINS>ШТ</MEINS>'
+             '<MAKTX>Изделие</MAKTX><VERID>0001</VERID></MATERIALDATA>'
+             '<BOMDATA><BOMHEADER><BASE_QUAN>1,000</BASE_QUAN></BOMHEADER>']
+    for number in range(bom_items):
+        parts.append(_BOM_ITEM.format(
+            category='L' if number % 5 else 'X',
+            component=number,
+            quantity=f'{number % 3 + 1}.000',
+            padding='x' * padding
+        ))
+    parts.append('</BOMDATA><ROUTINGDATA>')
+    for number in range(1, operations + 1):
+        parts.append(_ROUTING_OPERATION.format(
+            nop=number * 5,
+            labor=f'{number % 9 + 1}.25',
+            equipment=number % 20,
+            padding='x' * padding
+        ))
+    parts.append('</ROUTINGDATA></Material>')
+    return ''.join(parts).encode('utf-8')
+
+
+def _entities_snapshot(session):
+    return {
+        code: (
+            entity.identity, entity.name, entity.department, entity.labor,
+            entity.cycle, entity.route,
+            {child.code: amount for child, amount in entity.spec.items()}
+        )
+        for code, entity in session.entities.items()
+    }
+
+
+def _read_movement(parser):
+    return lambda document: parser(BytesIO(document))
+
+
+def _read_material(method_name):
+    def read(document):
+        session = ReadSession()
+        getattr(session, method_name)(BytesIO(document))
+        return _entities_snapshot(session)
+    return read
+
+
+PARSERS = {
+    'movement': {
+        'tree': _read_movement(KKFtpReader.parse_body_tree),
+        'stream': _read_movement(KKFtpReader.parse_body),
+    },
+    'material': {
+        'tree': _read_material('read_from_file_tree'),
+        'stream': _read_material('read_from_file'),
+    },
+}
+
+
+def _measure(read, document, repeats):
+    best = None
+    result = None
+    for _ in range(repeats):
+        started = perf_counter()
+        result = read(document)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    read(document)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def run_xml_benchmark(sizes, repeats=3, padding=50):
+    """
+    Сравнивает разбор с построением дерева и потоковый разбор на
+    синтетических документах: лучшее время из repeats запусков и пик
+    памяти по tracemalloc. Результаты разборов должны совпадать.
+    """
+    report = []
+    for size in sizes:
+        documents = {
+            'movement': make_movement_document(size, padding),
+            'material': make_material_document(size, size, padding),
+        }
+        for kind, document in documents.items():
+            results = {}
+            for name, read in PARSERS[kind].items():
+                result, seconds, peak = _measure(read, document, repeats)
+                results[name] = result
+                report.append({
+                    'document': kind,
+                    'size': size,
+                    'bytes': len(document),
+                    'parser': name,
+                    'seconds': round(seconds, 4),
+                    'peak_memory_mb': round(peak / 1024 / 1024, 2),
+                })
+            if results['tree'] != results['stream']:
+                raise AssertionError(
+                    f'Результаты разбора {kind} на {size} позиций '
+                    f'не совпадают'
+                )
+    return report
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--sizes', required=False,
+                        default='1000,10000,100000')
+    parser.add_argument('-r', '--repeats', required=False, type=int,
+                        default=3)
+    parser.add_argument('-p', '--padding', required=False, type=int,
+                        default=50)
+    args = parser.parse_args()
+
+    report = run_xml_benchmark(
+        [int(size) for size in args.sizes.split(',')],
+        repeats=args.repeats,
+        padding=args.padding
+    )
+    columns = ('document', 'size', 'bytes', 'parser', 'seconds',
+               'peak_memory_mb')
+    print(' | '.join(columns))
+    for row in report:
+        print(' | '.join(str(row[column]) for column in columns))
+
+
+if __name__ == '__main__':
+    main()
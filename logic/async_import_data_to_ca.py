@@ -0,0 +1,98 @@
+import asyncio
+from datetime import datetime
+
+from tqdm import tqdm
+
+from logic.import_data_to_ca import INDEXED_MODELS, _department_rows, \
+    _entity_rows, _group_routes, _group_equipment_classes, \
+    _equipment_class_row, _operation_row, _used_operations, _order_row, \
+    _entity_batch_row, _route_sheet_row, _route_sheet_operation_row, \
+    _sheet_started_message
+
+
+async def start_batches_async(ca_session, data):
+    await asyncio.gather(*(
+        ca_session.load_index(model) for model in INDEXED_MODELS
+    ))
+
+    routes = _group_routes(data)
+    equipment_class = _group_equipment_classes(data)
+    used_operations = _used_operations(data, routes)
+    start_date = datetime.now()
+
+    # справочники друг от друга не зависят -- создаем одновременно
+    departments, entities, equipment_class_ids, operation_ids, order_id = \
+        await asyncio.gather(
+            ca_session.create_objects('department', _department_rows(data)),
+            ca_session.create_objects('entity', _entity_rows(data)),
+            ca_session.create_objects(
+                'equipment_class',
+                [
+                    _equipment_class_row(operation, equipment_class)
+                    for operation in used_operations
+                ]
+            ),
+            ca_session.create_objects(
+                'operation',
+                [_operation_row(operation) for operation in used_operations]
+            ),
+            ca_session.create_object('order', _order_row(start_date))
+        )
+
+    entities_ids = {}
+    for row in data['bill_of_materials'].values():
+        entities_ids[row['PARENT_CODE']] = entities[str(row['PARENT_CODE'])]
+        entities_ids[row['CODE']] = entities[str(row['CODE'])]
+
+    context = {
+        'routes': routes,
+        'equipment_class': equipment_class,
+        'entities_ids': entities_ids,
+        'department_ids': {
+            row['DEPT_ID']: departments[str(row['DEPT_ID'])]
+            for row in data['departments'].values()
+        },
+        'equipment_class_ids': equipment_class_ids,
+        'operation_ids': operation_ids,
+        'order_id': order_id,
+        'start_date': start_date,
+        'calc_session_id': datetime.now().strftime('%Y%m%d'),
+    }
+
+    pbar = tqdm(total=len(data['batches']), desc='Запускаем партии')
+
+    async def launch(batch_id, batch_data):
+        entity_batch_id = await ca_session.create_object(
+            'entity_batch',
+            _entity_batch_row(batch_id, batch_data, data, context)
+        )
+        entity_route_sheet_id = await ca_session.create_object(
+            'entity_route_sheet',
+            _route_sheet_row(batch_id, batch_data, entity_batch_id, context)
+        )
+        await ca_session.create_objects(
+            'entity_route_sheet_operation',
+            [
+                _route_sheet_operation_row(
+                    batch_id, operation, entity_route_sheet_id, context
+                )
+                for operation in routes[batch_data['ROUTE_ID']]
+            ]
+        )
+        await ca_session.send_websocket_message(
+            _sheet_started_message(batch_id, entity_route_sheet_id)
+        )
+        pbar.update()
+        return entity_route_sheet_id
+
+    # цепочки партий идут одновременно, число запросов в полете
+    # ограничено семафором сессии
+    route_sheet_ids = await asyncio.gather(*(
+        launch(batch_id, batch_data)
+        for batch_id, batch_data in data['batches'].items()
+    ))
+    pbar.close()
+
+    report = dict(zip(data['batches'], route_sheet_ids))
+    tqdm.write(f'Запущено партий: {len(report)}')
+    return report
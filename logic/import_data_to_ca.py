@@ -1,57 +1,226 @@
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+from math import ceil
 
 from tqdm import tqdm
 
+from utils.list_to_dict import group_list, list_to_dict
+from utils.object_memo import ObjectMemo
+from utils.request_metrics import measure_phase
+from utils.session_pool import CARestSessionPool
 
-def start_batches(ca_session, data):
-    spec = defaultdict(dict)
-    department_ids = {}
-    for row in tqdm(data['departments'].values(), desc='Создаем подразделения'):
-        department_ids[row['DEPT_ID']] = ca_session.create_object(
-            model='department',
-            data={
-                'identity': str(row['DEPT_ID']),
-                'name': str(row['NAME'])
-            }
+_DATETIME_SIMPLE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# справочники, которые целиком читаются из СА до импорта, чтобы
+# не проверять существование каждого объекта отдельным запросом
+INDEXED_MODELS = [
+    'department',
+    'entity',
+    'equipment_class',
+    'operation',
+]
+
+
+def _department_rows(data):
+    return [
+        {
+            'identity': str(row['DEPT_ID']),
+            'name': str(row['NAME'])
+        } for row in data['departments'].values()
+    ]
+
+
+def _entity_rows(data):
+    entity_rows = []
+    for row in data['bill_of_materials'].values():
+        entity_rows.append({
+            'identity': str(row['PARENT_CODE']),
+            'code': str(row['PARENT_IDENTITY']),
+            'name': str(row['PARENT_NAME']),
+            'group': 1
+        })
+        entity_rows.append({
+            'identity': str(row['CODE']),
+            'code': str(row['IDENTITY']),
+            'name': str(row['NAME']),
+            'group': 1
+        })
+    return entity_rows
+
+
+def _group_routes(data):
+    if 'operations_by_route' in data:
+        return data['operations_by_route']
+    return group_list(data['operations'].values(), 'ROUTE_ID')
+
+
+def _group_equipment_classes(data):
+    if 'equipment_by_id' in data:
+        return data['equipment_by_id']
+    return list_to_dict(data['equipment'].values(), 'EQUIPMENT_ID')
+
+
+def _equipment_class_row(operation, equipment_class):
+    try:
+        return {
+            'identity': str(equipment_class[operation['EQUIPMENT_ID']][
+                'EQUIPMENT_ID']),
+            'name': str(equipment_class[operation['EQUIPMENT_ID']]['NAME'])
+        }
+    except KeyError:
+        return {
+            'identity': str(operation['EQUIPMENT_ID']),
+            'name': f"ИД {operation['EQUIPMENT_ID']}"
+        }
+
+
+def _operation_row(operation):
+    return {
+        'identity': str(operation['ID']),
+        'name': f"{operation['NAME']} ({operation['NORM_AMOUNT']})",
+        'nop': operation['NOP'],
+    }
+
+
+def _used_operations(data, routes):
+    # классы оборудования и операции создаем только для маршрутов,
+    # по которым есть партии
+    return [
+        operation
+        for batch_data in data['batches'].values()
+        for operation in routes[batch_data['ROUTE_ID']]
+    ]
+
+
+def _order_row(start_date):
+    return {
+        'name': "ORDER",
+        'priority': 1,
+        'start_date': start_date.strftime(_DATETIME_SIMPLE_FORMAT),
+        'stop_date': start_date.strftime(_DATETIME_SIMPLE_FORMAT)
+    }
+
+
+def _entity_batch_row(batch_id, batch_data, data, context):
+    return {
+        'identity': str(batch_id),
+        'entity_id': context['entities_ids'][
+            data['routes'][
+                batch_data['ROUTE_ID']
+            ]['CODE']
+        ],
+        'quantity': batch_data['AMOUNT'],
+        'calculation_session_id': context['calc_session_id'],
+        'calculation_identity': str(batch_id),
+        'providing_state': 2,
+        'order_id': context['order_id']
+    }
+
+
+def _route_sheet_row(batch_id, batch_data, entity_batch_id, context):
+    return {
+        'entity_batch_id': entity_batch_id,
+        'identity': str(batch_id),
+        'start_date': context['start_date'].strftime(_DATETIME_SIMPLE_FORMAT),
+        'stop_date': batch_data['DATE_TO'].strftime(_DATETIME_SIMPLE_FORMAT),
+        'type': 0,
+    }
+
+
+def _route_sheet_operation_row(batch_id, operation, entity_route_sheet_id,
+                               context):
+    start_date = context['start_date']
+    return {
+        'calculation_session_id': context['calc_session_id'],
+        'calculation_identity': f"{batch_id}_{operation['NOP']}",
+        'entity_route_sheet_id': entity_route_sheet_id,
+        'equipment_class_id': context['equipment_class_ids'][
+            _equipment_class_row(
+                operation, context['equipment_class']
+            )['identity']
+        ],
+        'department_id': context['department_ids'][operation['DEPT_ID']],
+        'operation_id': context['operation_ids'][str(operation['ID'])],
+        'start_date': start_date.strftime(_DATETIME_SIMPLE_FORMAT),
+        'stop_date': start_date.strftime(_DATETIME_SIMPLE_FORMAT),
+        'prod_time': round(1 / operation['NORM_AMOUNT'] * 60 * 60, 4)
+    }
+
+
+def _sheet_started_message(batch_id, entity_route_sheet_id):
+    return {
+        "event": "SHEET_STARTED",
+        "data": {
+            "sheetId": entity_route_sheet_id,
+            "sheetIdentity": batch_id
+        }
+    }
+
+
+def start_batches(ca_session, data, workers=1, session_factory=None,
+                  journal=None):
+    if workers > 1 and session_factory is None:
+        raise ValueError(
+            'Для параллельного запуска партий нужен session_factory'
         )
-    entities_ids = {}
-    for row in tqdm(data['bill_of_materials'].values(), desc='Создаем ДСЕ'):
-        spec[row['PARENT_CODE']][row['CODE']] = row['AMOUNT']
-        entities_ids[row['PARENT_CODE']] = ca_session.create_object(
-            model='entity',
-            data={
-                'identity': str(row['PARENT_CODE']),
-                'code': str(row['PARENT_IDENTITY']),
-                'name': str(row['PARENT_NAME']),
-                'group': 1
-            }
+    metrics = ca_session.metrics
+    routes = _group_routes(data)
+    equipment_class = _group_equipment_classes(data)
+    used_operations = _used_operations(data, routes)
+    rows = {
+        'department': _department_rows(data),
+        'entity': _entity_rows(data),
+        'equipment_class': [
+            _equipment_class_row(operation, equipment_class)
+            for operation in used_operations
+        ],
+        'operation': [
+            _operation_row(operation) for operation in used_operations
+        ],
+    }
+    memo = ObjectMemo(ca_session, journal=journal)
+    with measure_phase(metrics, 'Загрузка справочников СА'):
+        for model in INDEXED_MODELS:
+            # справочник, все объекты которого уже есть в журнале,
+            # из СА не читается
+            if not memo.covers(model, rows[model]):
+                ca_session.load_index(model)
+
+    with measure_phase(metrics, 'Подразделения'):
+        created = memo.create_objects(
+            'department', rows['department'], desc='Создаем подразделения'
         )
-        entities_ids[row['CODE']] = ca_session.create_object(
-            model='entity',
-            data={
-                'identity': str(row['CODE']),
-                'code': str(row['IDENTITY']),
-                'name': str(row['NAME']),
-                'group': 1
-            }
+        department_ids = {
+            row['DEPT_ID']: created[str(row['DEPT_ID'])]
+            for row in data['departments'].values()
+        }
+
+    with measure_phase(metrics, 'ДСЕ'):
+        created = memo.create_objects(
+            'entity', rows['entity'], desc='Создаем ДСЕ'
+        )
+        entities_ids = {}
+        for row in data['bill_of_materials'].values():
+            entities_ids[row['PARENT_CODE']] = created[str(row['PARENT_CODE'])]
+            entities_ids[row['CODE']] = created[str(row['CODE'])]
+
+    with measure_phase(metrics, 'Классы оборудования и операции'):
+        equipment_class_ids = memo.create_objects(
+            'equipment_class',
+            rows['equipment_class'],
+            desc='Создаем классы оборудования'
+        )
+        operation_ids = memo.create_objects(
+            'operation',
+            rows['operation'],
+            desc='Создаем операции'
         )
-    routes = defaultdict(list)
-    for row in data['operations'].values():
-        routes[row['ROUTE_ID']].append(row)
-    equipment_class = {}
-    for row in data['equipment'].values():
-        equipment_class[row['EQUIPMENT_ID']] = row
 
     start_date = datetime.now()
-    order_id = ca_session.create_object(
+    order_id = memo.create_object(
         model='order',
-        data={
-            'name': "ORDER",
-            'priority': 1,
-            'start_date': start_date.strftime('%Y-%m-%dT%H:%M:%S'),
-            'stop_date': start_date.strftime('%Y-%m-%dT%H:%M:%S')
-        }
+        data=_order_row(start_date)
     )
 
     # ca_session.create_object(
@@ -64,84 +233,135 @@ def start_batches(ca_session, data):
     #     }
     # )
 
-    for batch_id, batch_data in tqdm(data['batches'].items(), desc='Запускаем партии'):
-        calc_session_id = datetime.now().strftime('%Y%m%d')
-        entity_batch_id = ca_session.create_object(
-            'entity_batch',
-            {
-                'identity': str(batch_id),
-                'entity_id': entities_ids[
-                    data['routes'][
-                        batch_data['ROUTE_ID']
-                    ]['CODE']
-                ],
-                'quantity': batch_data['AMOUNT'],
-                'calculation_session_id': calc_session_id,
-                'calculation_identity': str(batch_id),
-                'providing_state': 2,
-                'order_id': order_id
-            }
-        )
-        entity_route_sheet_id = ca_session.create_object(
-            'entity_route_sheet',
-            {
-                'entity_batch_id': entity_batch_id,
-                'identity': str(batch_id),
-                'start_date': start_date.strftime('%Y-%m-%dT%H:%M:%S'),
-                'stop_date': batch_data['DATE_TO'].strftime('%Y-%m-%dT%H:%M:%S'),
-                'type': 0,
-            }
-        )
+    context = {
+        'routes': routes,
+        'equipment_class': equipment_class,
+        'entities_ids': entities_ids,
+        'department_ids': department_ids,
+        'equipment_class_ids': equipment_class_ids,
+        'operation_ids': operation_ids,
+        'order_id': order_id,
+        'start_date': start_date,
+        'calc_session_id': datetime.now().strftime('%Y%m%d'),
+    }
+    # партии, по которым журнал уже фиксирует отправку SHEET_STARTED,
+    # повторно не запускаем
+    started = set() if journal is None else journal.started
+    batches = [
+        (batch_id, batch_data)
+        for batch_id, batch_data in data['batches'].items()
+        if str(batch_id) not in started
+    ]
+    with measure_phase(metrics, 'Партии'):
+        if workers > 1:
+            launched = _launch_batches_parallel(
+                session_factory, memo, batches, data, context, workers
+            )
+        else:
+            launched = _launch_batches(
+                ca_session, memo, batches, data, context
+            )
+
+    tqdm.write(f'Повторных обращений к СА пропущено: {memo.avoided}')
+    tqdm.write(f'Запущено партий: {len(launched)}')
+    if len(batches) < len(data['batches']):
+        tqdm.write(f'Пропущено партий, запущенных ранее по журналу: '
+                   f'{len(data["batches"]) - len(batches)}')
+    return {
+        batch_id: memo.ids[('entity_route_sheet', str(batch_id))]
+        for batch_id in data['batches']
+    }
 
-        for operation in routes[batch_data['ROUTE_ID']]:
-            try:
-                equipment_class_id = ca_session.create_object(
-                    'equipment_class',
-                    {
-                        'identity': str(equipment_class[operation['EQUIPMENT_ID']][
-                            'EQUIPMENT_ID']),
-                        'name': str(equipment_class[operation['EQUIPMENT_ID']]['NAME'])
-                    }
-                )
-            except KeyError:
-                equipment_class_id = ca_session.create_object(
-                    'equipment_class',
-                    {
-                        'identity': str(operation['EQUIPMENT_ID']),
-                        'name': f"ИД {operation['EQUIPMENT_ID']}"
-                    }
-                )
-
-            operation_id = ca_session.create_object(
-                'operation',
-                {
-                    'identity': str(operation['ID']),
-                    'name': f"{operation['NAME']} ({operation['NORM_AMOUNT']})",
-                    'nop': operation['NOP'],
-                }
+
+def _launch_batches_parallel(session_factory, memo, batches, data, context,
+                             workers):
+    # партии независимы друг от друга, поэтому делим их на части
+    # и запускаем каждую часть в отдельном потоке со своей сессией
+    chunk_size = max(1, ceil(len(batches) / (workers * 4)))
+    chunks = [
+        batches[start:start + chunk_size]
+        for start in range(0, len(batches), chunk_size)
+    ]
+    launched = {}
+    with CARestSessionPool(session_factory) as pool, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        def launch_chunk(chunk):
+            worker_session = pool.get()
+            return _launch_batches(
+                worker_session,
+                memo.for_session(worker_session),
+                chunk,
+                data,
+                context,
+                progress=False
             )
 
-            ca_session.create_object(
-                'entity_route_sheet_operation',
-                {
-                    'calculation_session_id': calc_session_id,
-                    'calculation_identity': f"{batch_id}_{operation['NOP']}",
-                    'entity_route_sheet_id': entity_route_sheet_id,
-                    'equipment_class_id': equipment_class_id,
-                    'department_id': department_ids[operation['DEPT_ID']],
-                    'operation_id': operation_id,
-                    'start_date': start_date.strftime('%Y-%m-%dT%H:%M:%S'),
-                    'stop_date': start_date.strftime('%Y-%m-%dT%H:%M:%S'),
-                    'prod_time': round(1 / operation['NORM_AMOUNT'] * 60 * 60, 4)
-                }
+        for chunk_report in tqdm(
+                executor.map(launch_chunk, chunks),
+                total=len(chunks),
+                desc='Запускаем партии'
+        ):
+            launched.update(chunk_report)
+    return launched
+
+
+def _launch_batches(ca_session, memo, batches, data, context, progress=True):
+    entity_batch_ids = memo.create_objects(
+        'entity_batch',
+        [
+            _entity_batch_row(batch_id, batch_data, data, context)
+            for batch_id, batch_data in batches
+        ],
+        desc='Создаем партии',
+        progress=progress
+    )
+    entity_route_sheet_ids = memo.create_objects(
+        'entity_route_sheet',
+        [
+            _route_sheet_row(
+                batch_id,
+                batch_data,
+                entity_batch_ids[str(batch_id)],
+                context
+            )
+            for batch_id, batch_data in batches
+        ],
+        desc='Создаем маршрутные листы',
+        progress=progress
+    )
+    memo.create_objects(
+        'entity_route_sheet_operation',
+        [
+            _route_sheet_operation_row(
+                batch_id,
+                operation,
+                entity_route_sheet_ids[str(batch_id)],
+                context
             )
+            for batch_id, batch_data in batches
+            for operation in context['routes'][batch_data['ROUTE_ID']]
+        ],
+        desc='Создаем операции маршрутных листов',
+        progress=progress
+    )
 
+    report = {}
+    for batch_id, _ in tqdm(
+            batches, desc='Запускаем партии', disable=not progress
+    ):
+        # партия попадает в журнал как запущенная только после того,
+        # как сообщение действительно ушло в СА; неотправленные при
+        # --resume запускаются повторно
         ca_session.send_websocket_message(
-            {
-                "event": "SHEET_STARTED",
-                "data": {
-                    "sheetId": entity_route_sheet_id,
-                    "sheetIdentity": batch_id
-                }
-            }
-        )
\ No newline at end of file
+            _sheet_started_message(
+                batch_id, entity_route_sheet_ids[str(batch_id)]
+            ),
+            on_sent=partial(
+                memo.record_sent,
+                'entity_route_sheet',
+                str(batch_id),
+                entity_route_sheet_ids[str(batch_id)]
+            )
+        )
+        report[batch_id] = entity_route_sheet_ids[str(batch_id)]
+    return report
@@ -0,0 +1,156 @@
+from tqdm import tqdm
+
+from logic.import_data_to_ca import INDEXED_MODELS, start_batches, \
+    _department_rows, _entity_rows, _group_routes, _group_equipment_classes, \
+    _equipment_class_row, _operation_row, _used_operations
+
+
+def _filter_batches(data, batch_ids):
+    batch_ids = {str(batch_id) for batch_id in batch_ids}
+    filtered = dict(data)
+    filtered['batches'] = {
+        batch_id: batch_data
+        for batch_id, batch_data in data['batches'].items()
+        if str(batch_id) in batch_ids
+    }
+    return filtered
+
+
+def _batch_statuses(ca_session):
+    # {identity маршрутного листа: статус его партии СА}; читается
+    # из СА напрямую, мимо локальной копии -- статусы меняются на месте
+    statuses = {
+        row['id']: row['status']
+        for row in ca_session._iter_rest_collection('entity_batch')
+    }
+    return {
+        str(row['identity']): statuses.get(row['entity_batch_id'])
+        for row in ca_session._iter_rest_collection(
+            'entity_route_sheet', '&filter={ type eq 0 }'
+        )
+    }
+
+
+def build_plan(ca_session, data, journal=None):
+    """
+    Сравнивает входные данные с текущим состоянием СА и возвращает план:
+    какие объекты нужно создать, какие уже есть (их id и совпадают ли
+    они с входными данными) и в каком состоянии партии. Партии без
+    маршрутного листа запускаются; с листом активной партии считаются
+    запущенными, а если по журналу journal лист создан, но
+    SHEET_STARTED не отправлен, -- прерванными и запускаются повторно.
+    Партии, которые в СА уже остановлены или завершены, только
+    попадают в отчет.
+    """
+    statuses = _batch_statuses(ca_session)
+    plan = {
+        'started_batches': [],
+        'interrupted_batches': [],
+        'closed_batches': [],
+        'batches_to_start': [],
+        'create': {},
+        'ids': {},
+        'unchanged': {},
+        'changed': {},
+    }
+    for batch_id in data['batches']:
+        key = str(batch_id)
+        if key not in statuses:
+            plan['batches_to_start'].append(batch_id)
+        elif statuses[key] != 0:
+            plan['closed_batches'].append(batch_id)
+        elif journal is not None and \
+                ('entity_route_sheet', key) in journal.ids and \
+                key not in journal.started:
+            plan['interrupted_batches'].append(batch_id)
+        else:
+            plan['started_batches'].append(batch_id)
+
+    # справочники сравниваем только для партий, которые будут запущены
+    data = _filter_batches(data, _batches_to_launch(plan))
+    routes = _group_routes(data)
+    equipment_class = _group_equipment_classes(data)
+    used_operations = _used_operations(data, routes)
+    rows = {
+        'department': _department_rows(data),
+        'entity': _entity_rows(data),
+        'equipment_class': [
+            _equipment_class_row(operation, equipment_class)
+            for operation in used_operations
+        ],
+        'operation': [_operation_row(operation) for operation in used_operations],
+    }
+    for model in INDEXED_MODELS:
+        check_value = ca_session._check_column(model)
+        # поля сравниваются со строками из СА, а не из локальной копии:
+        # она догружает только новые строки и правок в СА не видит
+        existing = {
+            str(row[check_value]): row
+            for row in ca_session._iter_rest_collection(model)
+        }
+        to_create, unchanged, changed = {}, set(), set()
+        for row in rows[model]:
+            key = str(row[check_value])
+            if key not in existing:
+                to_create[key] = None
+            elif all(
+                    str(existing[key].get(column)) == str(value)
+                    for column, value in row.items()
+            ):
+                unchanged.add(key)
+            else:
+                changed.add(key)
+        plan['create'][model] = list(to_create)
+        plan['ids'][model] = {
+            key: existing[key]['id'] for key in unchanged | changed
+        }
+        plan['unchanged'][model] = len(unchanged)
+        plan['changed'][model] = sorted(changed)
+    return plan
+
+
+def print_plan(plan):
+    for model, identities in plan['create'].items():
+        tqdm.write(
+            f'{model}: создать {len(identities)}, '
+            f'без изменений {plan["unchanged"][model]}, '
+            f'отличаются от СА {len(plan["changed"][model])}'
+        )
+    tqdm.write(
+        f'Партии: запустить {len(plan["batches_to_start"])}, '
+        f'дозапустить прерванные {len(plan["interrupted_batches"])}, '
+        f'уже запущены {len(plan["started_batches"])}, '
+        f'остановлены или завершены в СА {len(plan["closed_batches"])}'
+    )
+
+
+def _batches_to_launch(plan):
+    return plan['batches_to_start'] + plan['interrupted_batches']
+
+
+def apply_plan(ca_session, data, plan, **kwargs):
+    """
+    Выполняет план: запускает новые и прерванные партии, запущенные,
+    остановленные и завершенные в СА пропускает.
+    Справочники из СА повторно не читаются -- индексы заполняются id
+    из плана, а объекты из create перед созданием ищутся точечно,
+    на случай если их создали после построения плана.
+    Объекты, которые отличаются от СА, не изменяются.
+    """
+    for model in INDEXED_MODELS:
+        index = dict(plan['ids'][model])
+        if plan['create'][model]:
+            index.update(
+                (str(key), object_id)
+                for key, object_id in ca_session._find_objects(
+                    model,
+                    ca_session._check_column(model),
+                    plan['create'][model]
+                ).items()
+            )
+        ca_session.index[model] = index
+    return start_batches(
+        ca_session,
+        _filter_batches(data, _batches_to_launch(plan)),
+        **kwargs
+    )
@@ -1,17 +1,58 @@
 import argparse
+import asyncio
+import json
 from argparse import ArgumentParser
 from os import getcwd
-from os.path import join
+from os.path import exists, join
 
 import urllib3
 
+from logic.async_import_data_to_ca import start_batches_async
 from logic.import_data_to_ca import start_batches
+from logic.import_plan import apply_plan, build_plan, print_plan
+from utils.async_carest import AsyncCARest
 from utils.carest import CARest
-from utils.excel import excel_to_dict
-from utils.list_to_dict import list_to_dict
+from utils.csv_tables import iter_input_sheets
+from utils.import_journal import ImportJournal
+from utils.request_metrics import RequestMetrics
+from utils.list_to_dict import group_list, list_to_dict
 from utils.yml_config import read_config
 
 
+KEY_COLUMNS = {
+    'batches': 'BATCH_ID',
+    'operations': 'ID',
+    'routes': 'ROUTE_ID',
+    'bill_of_materials': 'PARENT_CODE|CODE',
+    'departments': 'DEPT_ID',
+    'equipment': 'ID',
+}
+
+
+def read_input_data(path, columns):
+    # reading excel workbook or directory of csv/parquet files:
+    # only configured sheets, rows go straight to the index
+    sheet_columns = {name: column for column, name in columns.items()}
+    data_to_import = {column: {} for column in columns}
+    for name, rows in iter_input_sheets(path, sheet_columns):
+        column = sheet_columns[name]
+        data_to_import[column] = list_to_dict(
+            rows,
+            key_column=KEY_COLUMNS[column]
+        )
+
+    # secondary indexes, so start_batches does not regroup rows itself
+    data_to_import['operations_by_route'] = group_list(
+        data_to_import['operations'].values(),
+        key_column='ROUTE_ID'
+    )
+    data_to_import['equipment_by_id'] = list_to_dict(
+        data_to_import['equipment'].values(),
+        key_column='EQUIPMENT_ID'
+    )
+    return data_to_import
+
+
 def main():
     # reading execution parameters
     urllib3.disable_warnings()
@@ -26,36 +67,100 @@ def main():
     parser.add_argument('-f', '--file', required=True)
     parser.add_argument('-d', '--debug', required=False, action='store_true',
                         default=False)
+    parser.add_argument('-w', '--workers', required=False, type=int,
+                        default=1)
+    parser.add_argument('--async', required=False, action='store_true',
+                        default=False, dest='use_async')
+    parser.add_argument('-j', '--journal', required=False,
+                        default=join(getcwd(), 'start_batches.journal'))
+    parser.add_argument('--resume', required=False, action='store_true',
+                        default=False)
+    parser.add_argument('-m', '--metrics', required=False, default=None)
+    plan_group = parser.add_mutually_exclusive_group()
+    plan_group.add_argument('--plan', required=False, default=None)
+    plan_group.add_argument('--apply', required=False, default=None)
 
     args = parser.parse_args()
 
     config = read_config(args.config)
 
-    # reading excel
-    input_data = excel_to_dict(args.file)
-    KEY_COLUMNS = {
-        'batches': 'BATCH_ID',
-        'operations': 'ID',
-        'routes': 'ROUTE_ID',
-        'bill_of_materials': 'PARENT_CODE|CODE',
-        'departments': 'DEPT_ID',
-        'equipment': 'ID',
-    }
-
-    data_to_import = {}
-    for column, name in config['columns'].items():
-        if name in input_data:
-            data_to_import[column] = list_to_dict(
-                input_data[name],
-                key_column=KEY_COLUMNS[column]
+    data_to_import = read_input_data(args.file, config['columns'])
+
+    metrics = RequestMetrics()
+    try:
+        run_import(args, config, data_to_import, metrics)
+    finally:
+        if args.metrics:
+            metrics.dump(args.metrics)
+
+
+def run_import(args, config, data_to_import, metrics):
+    def make_session():
+        worker_session = CARest.from_config(config['CA'], metrics=metrics)
+        worker_session._perform_login()
+        return worker_session
+
+    async def start_batches_with_async_session():
+        async with AsyncCARest.from_config(
+                config['CA'], metrics=metrics
+        ) as async_session:
+            await async_session._perform_login()
+            await start_batches_async(async_session, data_to_import)
+
+    if args.use_async:
+        asyncio.run(start_batches_with_async_session())
+        return
+
+    if args.plan:
+        # журнал нужен плану, чтобы отличить прерванный запуск партии
+        # от запущенной партии
+        journal = ImportJournal(args.journal, resume=True) \
+            if exists(args.journal) else None
+        try:
+            with CARest.from_config(config['CA'], metrics=metrics) as session:
+                session._perform_login()
+                plan = build_plan(session, data_to_import, journal)
+        finally:
+            if journal is not None:
+                journal.close()
+        print_plan(plan)
+        with open(args.plan, 'w', encoding='utf-8') as output_file:
+            json.dump(plan, output_file, ensure_ascii=False, indent=2)
+        return
+
+    if args.apply:
+        with open(args.apply, 'r', encoding='utf-8') as input_file:
+            plan = json.load(input_file)
+        # журнал закрывается после сессии: подтверждения отправки
+        # websocket-сообщений пишутся в него при закрытии сессии
+        with ImportJournal(args.journal, resume=args.resume) as journal, \
+                CARest.from_config(
+                    config['CA'], workers=args.workers, metrics=metrics
+                ) as session:
+            session._perform_login()
+            apply_plan(
+                session,
+                data_to_import,
+                plan,
+                workers=args.workers,
+                session_factory=make_session,
+                journal=journal
             )
-        else:
-            data_to_import[column] = []
+        return
 
     # starting batches
-    with CARest.from_config(config['CA']) as session:
+    with ImportJournal(args.journal, resume=args.resume) as journal, \
+            CARest.from_config(
+                config['CA'], workers=args.workers, metrics=metrics
+            ) as session:
         session._perform_login()
-        start_batches(session, data_to_import)
+        start_batches(
+            session,
+            data_to_import,
+            workers=args.workers,
+            session_factory=make_session,
+            journal=journal
+        )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,324 @@
+import asyncio
+import json
+from itertools import chain
+from json import JSONDecodeError
+from time import perf_counter
+from urllib.parse import urljoin
+
+from aiohttp import ClientError, ClientSession, CookieJar, TCPConnector
+
+from base.base import Base
+from utils.carest import CARest
+from utils.request_log import RequestLog
+from utils.request_metrics import RequestMetrics
+from utils.websocket_sender import WebsocketSender
+
+__all__ = [
+    'AsyncCARest',
+]
+
+
+class AsyncCARest(Base):
+    """
+    Асинхронный аналог CARest на aiohttp. Число одновременных запросов
+    к СА ограничивается семафором на max_in_flight запросов.
+    """
+    KEY_ROWS = CARest.KEY_ROWS
+    BULK_CHUNK_SIZE = CARest.BULK_CHUNK_SIZE
+    MAX_URL_LENGTH = CARest.MAX_URL_LENGTH
+    PAGE_SIZE = CARest.PAGE_SIZE
+    MAX_IN_FLIGHT = 100
+
+    def __init__(self, login, password, base_url, ws_url, verify,
+                 *args, max_in_flight=None, metrics=None,
+                 log_payload_limit=1000, log_sample_rate=1.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._base_url = base_url
+        self._login = login
+        self._password = password
+        self._verify = verify
+        self.ws_url = ws_url
+        self._websocket = WebsocketSender(f'{ws_url}/message')
+
+        self._max_in_flight = max_in_flight or self.MAX_IN_FLIGHT
+        self._session = None
+        self._semaphore = None
+
+        self.cache = {}
+        self.index = {}
+        self.metrics = metrics or RequestMetrics()
+        self._request_log = RequestLog(
+            self._logger, log_payload_limit, log_sample_rate
+        )
+
+    async def __aenter__(self):
+        # семафор создается внутри работающего цикла событий
+        self._semaphore = asyncio.BoundedSemaphore(self._max_in_flight)
+        self._session = ClientSession(
+            connector=TCPConnector(
+                limit=self._max_in_flight,
+                ssl=None if self._verify else False
+            ),
+            cookie_jar=CookieJar(unsafe=True)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._websocket.close
+        )
+        await self._session.close()
+
+    def _make_url(self, uri):
+        return urljoin(self._base_url, uri)
+
+    def _check_column(self, model):
+        return self.KEY_ROWS.get(model) or 'identity'
+
+    async def load_index(self, model):
+        if model not in self.index:
+            check_value = self._check_column(model)
+            self.index[model] = {
+                str(row[check_value]): row['id']
+                for row in await self._get_from_rest_collection(model)
+            }
+        return self.index[model]
+
+    async def create_object(self, model, data):
+        check_value = self._check_column(model)
+        if model != 'order_entry' and model in self.index:
+            index = self.index[model]
+            key = str(data[check_value])
+            if key not in index:
+                index[key] = (await self._perform_post(
+                    f'rest/{model}',
+                    {
+                        model: [
+                            data
+                        ]
+                    }
+                ))[model][0]['id']
+            return index[key]
+        if model == 'order_entry':
+            found = await self._perform_get(
+                f'rest/collection/{model}?'
+                f'filter={{order_id eq {data["order_id"]} and'
+                f'entity_id eq {data["entity_id"]}}}'
+            )
+        else:
+            found = await self._perform_get(
+                f'rest/collection/{model}?filter={{{check_value} eq {data[check_value]}}}'
+            )
+        if model not in found:
+            found = await self._perform_post(
+                f'rest/{model}',
+                {
+                    model: [
+                        data
+                    ]
+                }
+            )
+        if model == 'order_entry':
+            return found[model][0]
+        return found[model][0]['id']
+
+    async def _find_objects(self, model, check_value, values):
+        report = {}
+        for uri in CARest._lookup_uris(self._base_url, model, check_value,
+                                       values, self.MAX_URL_LENGTH):
+            response = await self._perform_get(uri, check_status=True)
+            if not isinstance(response, dict):
+                raise ValueError(
+                    f'Ответ СА на поиск {model} не в формате JSON'
+                )
+            report.update(
+                (row[check_value], row['id'])
+                for row in response.get(model, [])
+            )
+        return report
+
+    async def _create_chunk(self, model, check_value, chunk, index):
+        report = {}
+        if index is not None:
+            for row in chunk:
+                key = str(row[check_value])
+                if key in index:
+                    report[row[check_value]] = index[key]
+        else:
+            report.update(await self._find_objects(
+                model,
+                check_value,
+                [row[check_value] for row in chunk]
+            ))
+        to_create = [
+            row for row in chunk if row[check_value] not in report
+        ]
+        if to_create:
+            created = (await self._perform_post(
+                f'rest/{model}',
+                {
+                    model: to_create
+                }
+            ))[model]
+            created_ids = CARest._created_ids(
+                model, check_value, to_create, created
+            )
+            report.update(created_ids)
+            if index is not None:
+                index.update(
+                    (str(key), object_id)
+                    for key, object_id in created_ids.items()
+                )
+        return report
+
+    async def create_objects(self, model, rows, chunk_size=None, **kwargs):
+        """
+        Массовое создание объектов модели, как в CARest.create_objects,
+        но чанки отправляются одновременно.
+        """
+        check_value = self._check_column(model)
+        chunk_size = chunk_size or self.BULK_CHUNK_SIZE
+        unique_rows = {}
+        for row in rows:
+            unique_rows.setdefault(row[check_value], row)
+        rows = list(unique_rows.values())
+        index = self.index.get(model)
+
+        report = {}
+        for chunk_report in await asyncio.gather(*(
+                self._create_chunk(
+                    model,
+                    check_value,
+                    rows[start:start + chunk_size],
+                    index
+                )
+                for start in range(0, len(rows), chunk_size)
+        )):
+            report.update(chunk_report)
+        return report
+
+    async def _get_collection_page(self, table, start):
+        return await self._perform_get(
+            f'rest/collection/{table}'
+            f'?start={start}'
+            f'&stop={start + self.PAGE_SIZE}'
+            f'{CARest._collection_order_by(table)}'
+        )
+
+    async def _get_from_rest_collection(self, table):
+        if table not in self.cache:
+            await self._perform_login()
+            # первая страница сообщает число строк, остальные
+            # запрашиваются одновременно
+            first_page = await self._get_collection_page(table, 0)
+            pages = [first_page] + list(await asyncio.gather(*(
+                self._get_collection_page(table, start)
+                for start in range(
+                    self.PAGE_SIZE,
+                    first_page['meta']['count'],
+                    self.PAGE_SIZE
+                )
+            )))
+            self.cache[table] = list(chain.from_iterable(
+                page.get(table, []) for page in pages
+            ))
+        return self.cache[table]
+
+    async def send_websocket_message(self, data: dict, on_sent=None):
+        # постановка в очередь не блокирует, отправка идет
+        # из фонового потока WebsocketSender
+        self._websocket.send(data, on_sent)
+
+    async def _perform_json_request(self, http_method, uri,
+                                    check_status=False, **kwargs):
+        url = self._make_url(uri)
+        extra = self._request_log.start(http_method, url)
+        self._request_log.payload(extra, 'Отправляемые данные', kwargs)
+        kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                 **{'X-Request-Id': extra['request_id']})
+
+        async with self._semaphore:
+            started = perf_counter()
+            try:
+                async with self._session.request(http_method,
+                                                 url=url,
+                                                 **kwargs) as response:
+                    body = await response.read()
+            except ClientError:
+                self.metrics.record(http_method, uri,
+                                    perf_counter() - started, error=True)
+                raise
+            latency = perf_counter() - started
+        try:
+            response_json = json.loads(body)
+        except JSONDecodeError:
+            self.metrics.record(http_method, uri, latency,
+                                bytes_received=len(body), error=True)
+            self._request_log.error(extra, response)
+            if check_status:
+                response.raise_for_status()
+            return response
+        self.metrics.record(http_method, uri, latency,
+                            bytes_received=len(body),
+                            error=response.status >= 400)
+        if check_status:
+            response.raise_for_status()
+
+        self._request_log.payload(extra, 'Получен ответ', response_json)
+        return response_json
+
+    async def _perform_get(self, uri, check_status=False):
+        return await self._perform_json_request('GET', uri,
+                                                check_status=check_status)
+
+    async def _perform_post(self, uri, data, check_status=False):
+        return await self._perform_json_request('POST', uri,
+                                                check_status=check_status,
+                                                json=data)
+
+    async def _perform_action(self, uri_part, check_status=False, **data):
+        return await self._perform_post(
+            '/action/{}'.format(uri_part),
+            data=data,
+            check_status=check_status
+        )
+
+    async def _perform_login(self):
+        return (await self._perform_action(
+            'login',
+            data={
+                'login': self._login,
+                'password': self._password
+            },
+            action='login'
+        ))['data']
+
+    async def stop_batch(self, identity):
+        return await self._perform_action(
+            'entity_batch/stop',
+            check_status=True,
+            data={'entity_route_sheet_identity': identity}
+        )
+
+    async def start_batch(self, batch, route_sheet):
+        return await self._perform_action(
+            f'entity_batch/start',
+            data={
+                'entity_batch_identity': batch,
+                'entity_route_sheet_identity': route_sheet
+            }
+        )
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        return cls(
+            config['login'],
+            config['password'],
+            config['url'],
+            config['ws_url'],
+            config['verify'],
+            max_in_flight=config.get('max_in_flight'),
+            log_payload_limit=config.get('log_payload_limit', 1000),
+            log_sample_rate=config.get('log_sample_rate', 1.0),
+            **kwargs
+        )
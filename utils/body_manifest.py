@@ -0,0 +1,87 @@
+import json
+import os
+from os.path import exists
+
+__all__ = [
+    'BodyManifest',
+]
+
+
+class BodyManifest(object):
+    """
+    Манифест обработанных файлов body: для каталога запроса хранит
+    mtime каталога, размер и mtime body и результат разбора. Каждый
+    разобранный документ дописывается строкой JSON в журнал
+    {path}.log, при закрытии журнал сворачивается в снимок path
+    (временный файл + os.replace) и удаляется. После падения снимок
+    и недописанный журнал читаются вместе.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = f'{path}.log'
+        self.entries = {}
+        if exists(path):
+            with open(path, 'r', encoding='utf-8') as manifest_file:
+                self.entries = json.load(manifest_file)
+        complete = True
+        if exists(self.log_path):
+            complete = self._load_log()
+        self._log = open(self.log_path, 'a', encoding='utf-8')
+        if not complete:
+            self._log.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load_log(self):
+        line = '\n'
+        with open(self.log_path, 'r', encoding='utf-8') as log_file:
+            for line in log_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # последняя строка могла не дописаться при падении
+                    continue
+                self.entries[entry.pop('path')] = entry
+        return line.endswith('\n')
+
+    def is_current(self, path, dir_mtime):
+        # каталог не менялся с прошлого разбора -- листать его не нужно
+        entry = self.entries.get(path)
+        return entry is not None and entry['dir_mtime'] == dir_mtime
+
+    def is_processed(self, path, size, mtime):
+        entry = self.entries.get(path)
+        return entry is not None and \
+            entry['size'] == size and entry['mtime'] == mtime
+
+    def record(self, path, dir_mtime, size, mtime, outcome):
+        entry = {
+            'dir_mtime': dir_mtime,
+            'size': size,
+            'mtime': mtime,
+            'outcome': outcome,
+        }
+        self.entries[path] = entry
+        self._log.write(json.dumps(dict(entry, path=path),
+                                   ensure_ascii=False) + '\n')
+        self._log.flush()
+
+    def save(self):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(self.entries, manifest_file, ensure_ascii=False,
+                      separators=(',', ':'))
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        # журнал удаляется только после того, как снимок записан
+        self._log.close()
+        self.save()
+        os.remove(self.log_path)
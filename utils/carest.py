@@ -1,15 +1,17 @@
-import json
-import ssl
 import urllib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import partialmethod
+from itertools import chain, islice
 from json import JSONDecodeError
 from logging import basicConfig, DEBUG
+from time import perf_counter
 from urllib.parse import urljoin
 
-from requests import Session
+from requests import HTTPError, RequestException, Response
+from requests.utils import requote_uri
 from tqdm import tqdm
-from websocket import create_connection
 
 from base.base import Base
 
@@ -17,7 +19,13 @@ __all__ = [
     'CARest',
 ]
 
+from utils.collection_store import CollectionStore
+from utils.http_transport import SAFE_ACTIONS, make_session
+from utils.json_stream import ijson, read_collection_page
 from utils.list_to_dict import list_to_dict
+from utils.request_log import RequestLog
+from utils.request_metrics import RequestMetrics
+from utils.websocket_sender import WebsocketSender
 
 _DATETIME_SIMPLE_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
@@ -28,25 +36,44 @@ class CARest(Base):
         'order': 'name',
         'role': 'name'
     }
+    BULK_CHUNK_SIZE = 500
+    # прокси и веб-серверы обычно не принимают ссылки длиннее 8 КБ,
+    # поиск по чанку делится на запросы с ссылкой не длиннее этой
+    MAX_URL_LENGTH = 4000
+    PAGE_SIZE = 100000
+    PAGE_WORKERS = 4
+    STOP_WORKERS = 8
+    # страницы таблиц разбираются потоково, если установлен ijson
+    STREAM_PAGES = True
 
     def __init__(self, login, password, base_url, ws_url, verify,
-                 *args, **kwargs):
+                 *args, store=None, metrics=None, http_session=None,
+                 log_payload_limit=1000, log_sample_rate=1.0, **kwargs):
         super().__init__(*args, **kwargs)
         self._base_url = base_url
         self._login = login
         self._password = password
 
-        self._session = Session()
+        self._session = http_session or make_session(base_url, verify)
         self.ws_url = ws_url
-        self._session.verify = verify
+        self._websocket = WebsocketSender(f'{ws_url}/message')
 
         self.cache = {}
+        self.index = {}
+        self._store = store
+        self.metrics = metrics or RequestMetrics()
+        self._request_log = RequestLog(
+            self._logger, log_payload_limit, log_sample_rate
+        )
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._websocket.close()
         self._session.close()
+        if self._store is not None:
+            self._store.close()
 
     def _make_url(self, uri):
         return urljoin(self._base_url, uri)
@@ -68,8 +95,38 @@ class CARest(Base):
                 f'and {{ entity_batch.entity_id eq {entity_id} }}'
             )
 
+    def _check_column(self, model):
+        return self.KEY_ROWS.get(model) or 'identity'
+
+    def load_index(self, model):
+        """
+        Загружает индекс {значение ключевого поля: id} по модели одним
+        постраничным чтением таблицы. Пока индекс загружен, проверка
+        существования объектов не требует запросов к СА.
+        """
+        if model not in self.index:
+            check_value = self._check_column(model)
+            self.index[model] = {
+                str(row[check_value]): row['id']
+                for row in self._get_from_rest_collection(model)
+            }
+        return self.index[model]
+
     def create_object(self, model, data):
-        check_value = self.KEY_ROWS.get(model) or 'identity'
+        check_value = self._check_column(model)
+        if model != 'order_entry' and model in self.index:
+            index = self.index[model]
+            key = str(data[check_value])
+            if key not in index:
+                index[key] = self._perform_post(
+                    f'rest/{model}',
+                    {
+                        model: [
+                            data
+                        ]
+                    }
+                )[model][0]['id']
+            return index[key]
         try:
             if model == 'order_entry':
                 return self._perform_get(
@@ -101,98 +158,364 @@ class CARest(Base):
                     }
                 )[model][0]['id']
 
+    @staticmethod
+    def _lookup_uris(base_url, model, check_value, values, max_length):
+        """
+        Делит поиск значений ключевого поля на запросы с фильтром
+        {check_value eq value} or ..., ссылка каждого из которых после
+        кодирования не длиннее max_length символов.
+        """
+        prefix = f'rest/collection/{model}?filter='
+        separator = ' or '
+        separator_length = len(requote_uri(separator))
+        base_length = len(requote_uri(urljoin(base_url, prefix)))
+        terms = []
+        length = base_length
+        for value in values:
+            term = f'{{{check_value} eq {value}}}'
+            term_length = len(requote_uri(term))
+            if terms and \
+                    length + separator_length + term_length > max_length:
+                yield prefix + separator.join(terms)
+                terms = []
+                length = base_length
+            if terms:
+                length += separator_length
+            terms.append(term)
+            length += term_length
+        if terms:
+            yield prefix + separator.join(terms)
+
+    @staticmethod
+    def _created_ids(model, check_value, rows, created):
+        """
+        Сопоставляет созданные СА строки отправленным по ключевому полю.
+        Если ключевого поля в ответе нет, строки сопоставляются по
+        порядку, но только при совпадении их числа.
+        """
+        if len(created) != len(rows):
+            raise ValueError(
+                f'СА вернул {len(created)} созданных {model} '
+                f'вместо {len(rows)}'
+            )
+        if not all(check_value in created_row for created_row in created):
+            return {
+                row[check_value]: created_row['id']
+                for row, created_row in zip(rows, created)
+            }
+        ids = {
+            str(created_row[check_value]): created_row['id']
+            for created_row in created
+        }
+        try:
+            return {row[check_value]: ids[str(row[check_value])]
+                    for row in rows}
+        except KeyError as error:
+            raise ValueError(
+                f'СА не вернул созданный {model} {error.args[0]}'
+            ) from None
+
+    def _find_objects(self, model, check_value, values):
+        # запрос на часть чанка, ограниченную длиной ссылки,
+        # вместо GET на каждый объект
+        report = {}
+        for uri in self._lookup_uris(self._base_url, model, check_value,
+                                     values, self.MAX_URL_LENGTH):
+            response = self._perform_get(uri, check_status=True)
+            if not isinstance(response, dict):
+                # не найденный из-за ошибки объект был бы создан повторно
+                raise ValueError(
+                    f'Ответ СА на поиск {model} не в формате JSON'
+                )
+            report.update(
+                (row[check_value], row['id'])
+                for row in response.get(model, [])
+            )
+        return report
+
+    def create_objects(self, model, rows, chunk_size=None, desc=None,
+                       progress=True):
+        """
+        Массовое создание объектов модели: существующие ищутся и
+        создаются чанками по chunk_size строк за один запрос.
+        Возвращает словарь {значение ключевого поля: id}.
+        """
+        check_value = self._check_column(model)
+        chunk_size = chunk_size or self.BULK_CHUNK_SIZE
+        unique_rows = {}
+        for row in rows:
+            unique_rows.setdefault(row[check_value], row)
+        rows = list(unique_rows.values())
+        index = self.index.get(model)
+
+        report = {}
+        pbar = tqdm(
+            total=len(rows),
+            desc=desc or f'Создаем {model}',
+            disable=not progress
+        )
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            if index is not None:
+                for row in chunk:
+                    key = str(row[check_value])
+                    if key in index:
+                        report[row[check_value]] = index[key]
+            else:
+                report.update(self._find_objects(
+                    model,
+                    check_value,
+                    [row[check_value] for row in chunk]
+                ))
+            to_create = [
+                row for row in chunk if row[check_value] not in report
+            ]
+            if to_create:
+                created = self._perform_post(
+                    f'rest/{model}',
+                    {
+                        model: to_create
+                    }
+                )[model]
+                created_ids = self._created_ids(
+                    model, check_value, to_create, created
+                )
+                report.update(created_ids)
+                if index is not None:
+                    index.update(
+                        (str(key), object_id)
+                        for key, object_id in created_ids.items()
+                    )
+            pbar.update(len(chunk))
+        pbar.close()
+        return report
+
+    @staticmethod
+    def _collection_order_by(table):
+        if table == 'specification_item':
+            return '&order_by=parent_id&order_by=child_id'
+        elif table == 'operation_profession':
+            return '&order_by=operation_id&order_by=profession_id'
+        elif table == 'order_entry':
+            return '&order_by=order_id&order_by=priority'
+        elif table == 'entity_route_sheet_operation_feature_value':
+            return '&order_by=entity_route_sheet_operation_id&' \
+                   'order_by=entity_route_sheet_operation_feature_id'
+        else:
+            return '&order_by=id'
+
+    def _get_collection_page(self, table, start, query=''):
+        return self._perform_collection_get(
+            table,
+            f'rest/collection/{table}'
+            f'?start={start}'
+            f'&stop={start + self.PAGE_SIZE}'
+            f'{self._collection_order_by(table)}'
+            f'{query}'
+        )
+
+    def _iter_rest_collection_pages(self, table, query=''):
+        """
+        Постранично читает таблицу. Первая страница сообщает общее число
+        строк, остальные страницы запрашиваются одновременно в
+        PAGE_WORKERS потоков, но отдаются строго по порядку. Вперед
+        загружается не больше PAGE_WORKERS страниц.
+        """
+        self._perform_login()
+        step = self.PAGE_SIZE
+        first_page = self._get_collection_page(table, 0, query)
+        count = first_page['meta']['count']
+        pbar = tqdm(
+            total=count,
+            desc=f'Получение данных из таблицы {table}'
+        )
+        rows = first_page.get(table)
+        del first_page
+        if not rows:
+            pbar.close()
+            return
+        pbar.update(min(step, count))
+        yield rows
+
+        starts = iter(range(step, count, step))
+        with ThreadPoolExecutor(max_workers=self.PAGE_WORKERS) as executor:
+            pending = deque(
+                executor.submit(self._get_collection_page, table, start, query)
+                for start in islice(starts, self.PAGE_WORKERS)
+            )
+            while pending:
+                page = pending.popleft().result()
+                for start in islice(starts, 1):
+                    pending.append(executor.submit(
+                        self._get_collection_page, table, start, query
+                    ))
+                rows = page.get(table)
+                if not rows:
+                    break
+                pbar.update(len(rows))
+                yield rows
+        pbar.close()
+
+    def _iter_rest_collection(self, table, query=''):
+        # строки таблицы без сохранения в кэш -- для однократного просмотра
+        for rows in self._iter_rest_collection_pages(table, query):
+            yield from rows
+
     def _get_from_rest_collection(self, table):
         if table not in self.cache:
-            self.cache[table] = []
-            self._perform_login()
-            counter = 0
-            step = 100000
-            if table == 'specification_item':
-                order_by = '&order_by=parent_id&order_by=child_id'
-            elif table == 'operation_profession':
-                order_by = '&order_by=operation_id&order_by=profession_id'
-            elif table == 'order_entry':
-                order_by = '&order_by=order_id&order_by=priority'
-            elif table == 'entity_route_sheet_operation_feature_value':
-                order_by = '&order_by=entity_route_sheet_operation_id&' \
-                           'order_by=entity_route_sheet_operation_feature_id'
+            if self._store is not None and \
+                    self._collection_order_by(table) == '&order_by=id':
+                self.cache[table] = self._sync_with_store(table)
             else:
-                order_by = '&order_by=id'
-            pbar = tqdm(desc=f'Получение данных из таблицы {table}')
-            while True:
-                temp = self._perform_get(
-                    f'rest/collection/{table}'
-                    f'?start={counter}'
-                    f'&stop={counter + step}'
-                    f'{order_by}'
-                )
-                pbar.total = temp['meta']['count']
-                counter += step
-                pbar.update(min(
-                    step,
-                    temp['meta']['count'] - (counter - step)
+                self.cache[table] = list(chain.from_iterable(
+                    self._iter_rest_collection_pages(table)
                 ))
-                if table not in temp:
-                    break
-                self.cache[table] += temp[table]
-                if counter >= temp['meta']['count']:
-                    break
         return self.cache[table]
 
+    def _sync_with_store(self, table):
+        # из СА догружаются только строки с id больше уже сохраненных;
+        # если после этого число строк в копии не совпадает с СА
+        # (строки удалялись), таблица загружается заново целиком.
+        # Строки, измененные в СА на месте, не обновляются, поэтому
+        # копии можно доверять только соответствие ключа и id
+        high_water = self._store.high_water(table)
+        if high_water is not None:
+            self._store.save(table, chain.from_iterable(
+                self._iter_rest_collection_pages(
+                    table, f'&filter={{id gt {high_water}}}'
+                )
+            ))
+            if self._store.count(table) == self._collection_count(table):
+                return self._store.load(table)
+            self._logger.warning(
+                'Локальная копия таблицы {} расходится с СА, '
+                'загружаем ее заново'.format(table)
+            )
+        self._store.replace(table, chain.from_iterable(
+            self._iter_rest_collection_pages(table)
+        ))
+        return self._store.load(table)
+
+    def _collection_count(self, table):
+        return self._perform_get(
+            f'rest/collection/{table}?start=0&stop=1',
+            check_status=True
+        )['meta']['count']
+
     def _get_main_session(self):
         return self._perform_get('action/primary_simulation_session')['data']
 
-    def send_websocket_message(self, data: dict):
-        ws = create_connection(
-            f'{self.ws_url}/message',
-            sslopt={'cert_reqs': ssl.CERT_NONE}
-        )
+    def send_websocket_message(self, data: dict, on_sent=None):
+        # отправка идет из фонового потока WebsocketSender, on_sent
+        # вызывается после успешной отправки
+        self._websocket.send(data, on_sent)
 
-        ws.send(
-            json.dumps(
-                {
-                    "type": "CYBER_ASSISTANT_CLIENT_SOCKET_MESSAGE",
-                    "data": [data]
-                }
-            )
-        )
-
-    def _perform_json_request(self, http_method, uri, **kwargs):
+    def _perform_json_request(self, http_method, uri, check_status=False,
+                              **kwargs):
         url = self._make_url(uri)
-        logger = self._logger
+        extra = self._request_log.start(http_method, url)
+        self._request_log.payload(extra, 'Отправляемые данные', kwargs)
+        kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                 **{'X-Request-Id': extra['request_id']})
 
-        logger.info('Выполнение {} запроса '
-                    'по ссылке {!r}.'.format(http_method, url))
-
-        logger.debug('Отправляемые данные: {!r}.'.format(kwargs))
+        started = perf_counter()
+        try:
+            response = self._session.request(http_method,
+                                             url=url,
+                                             **kwargs)
+        except RequestException:
+            self.metrics.record(http_method, uri, perf_counter() - started,
+                                error=True)
+            raise
+        result = self._decode_response(extra, uri, response,
+                                       perf_counter() - started)
+        if check_status and response.status_code >= 400:
+            # ошибка СА приходит и с JSON-телом, по одному разбору
+            # ответа ее не отличить от успеха
+            raise HTTPError(
+                '{} {}: {}'.format(response.status_code, url,
+                                   response.text[:500]),
+                response=response
+            )
+        return result
 
-        response = self._session.request(http_method,
-                                         url=url,
-                                         **kwargs)
+    def _decode_response(self, extra, uri, response, latency):
+        http_method = extra['http_method']
+        bytes_sent = len(response.request.body or b'') \
+            if response.request is not None else 0
         try:
             response_json = response.json()
         except JSONDecodeError:
-            logger.error('Получен ответ на {} запрос по ссылке {!r}: '
-                         '{!r}'.format(http_method, url, response))
+            self.metrics.record(http_method, uri, latency, bytes_sent,
+                                len(response.content), error=True)
+            self._request_log.error(extra, response)
             return response
             raise JSONDecodeError
+        self.metrics.record(http_method, uri, latency, bytes_sent,
+                            len(response.content),
+                            error=response.status_code >= 400)
 
-        logger.debug('Получен ответ на {} запрос по ссылке {!r}: '
-                     '{!r}'.format(http_method, url, response_json))
+        self._request_log.payload(extra, 'Получен ответ', response_json)
         return response_json
 
     _perform_get = partialmethod(_perform_json_request, 'GET')
 
-    def _perform_post(self, uri, data):
-        return self._perform_json_request('POST', uri, json=data)
+    def _perform_collection_get(self, table, uri):
+        """
+        GET страницы таблицы с разбором строк по мере получения тела
+        ответа. Без ijson страница читается обычным _perform_get.
+        """
+        if ijson is None or not self.STREAM_PAGES:
+            return self._perform_get(uri)
+        url = self._make_url(uri)
+        extra = self._request_log.start('GET', url)
+
+        started = perf_counter()
+        try:
+            response = self._session.request(
+                'GET',
+                url=url,
+                headers={'X-Request-Id': extra['request_id']},
+                stream=True
+            )
+        except RequestException:
+            self.metrics.record('GET', uri, perf_counter() - started,
+                                error=True)
+            raise
+        with response:
+            if response.status_code >= 400:
+                # ответ с ошибкой короткий, разбираем его как обычно
+                return self._decode_response(
+                    extra, uri, response, perf_counter() - started
+                )
+            # gzip-ответ распаковывается при чтении из raw
+            response.raw.decode_content = True
+            try:
+                page = read_collection_page(response.raw, table)
+            except ijson.JSONError:
+                self.metrics.record('GET', uri, perf_counter() - started,
+                                    bytes_received=response.raw.tell(),
+                                    error=True)
+                self._request_log.error(extra, response)
+                return response
+            self.metrics.record('GET', uri, perf_counter() - started,
+                                bytes_received=response.raw.tell())
+        self._request_log.payload(extra, 'Получен ответ', page)
+        return page
+
+    def _perform_post(self, uri, data, check_status=False):
+        return self._perform_json_request('POST', uri,
+                                          check_status=check_status,
+                                          json=data)
 
     def _perform_put(self, uri, data):
         return self._perform_json_request('PUT', uri, json=data)
 
-    def _perform_action(self, uri_part, **data):
+    def _perform_action(self, uri_part, check_status=False, **data):
         return self._perform_post(
             '/action/{}'.format(uri_part),
-            data=data
+            data=data,
+            check_status=check_status
         )
 
     def _perform_login(self):
@@ -206,37 +529,94 @@ class CARest(Base):
         )['data']
 
     def get_order(self, order_name):
-        orders = self._get_from_rest_collection('order')
+        orders = self._iter_rest_collection(
+            'order',
+            f'&filter={{ name eq {order_name} }}'
+        )
         for order in orders:
             if order['name'] == order_name and order['status'] in [0, 1]:
                 return order
         return None
 
     def get_order_entry(self, order_id):
-        order_entries = self._get_from_rest_collection('order_entry')
-        entities = list_to_dict(self._get_from_rest_collection('entity'))
+        response = self._perform_get(
+            f'rest/collection/order_entry?'
+            f'with=entity&'
+            f'filter={{ order_id eq {order_id} }}'
+        )
+        entities = list_to_dict(response.get('entity', []))
         report = []
-        for order_entry in order_entries:
-            if order_entry['order_id'] == order_id:
-                report.append({
-                    'ENTITY_ID': order_entry['entity_id'],
-                    'ENTITY_IDENTITY': entities[order_entry['entity_id']]['identity'],
-                    'AMOUNT': order_entry['quantity']
-                })
+        for order_entry in response.get('order_entry', []):
+            report.append({
+                'ENTITY_ID': order_entry['entity_id'],
+                'ENTITY_IDENTITY': entities[order_entry['entity_id']]['identity'],
+                'AMOUNT': order_entry['quantity']
+            })
         return report
 
     def stop_batch(self, identity):
+        # отказ СА (4xx/5xx) поднимает HTTPError, чтобы остановка
+        # не считалась успешной
         return self._perform_action(
             'entity_batch/stop',
+            check_status=True,
             data={'entity_route_sheet_identity': identity}
         )
 
-    def stop_all_batches(self, order_id):
-        route_sheets = self._get_from_rest_collection('entity_route_sheet')
-        batches = list_to_dict(self._get_from_rest_collection('entity_batch'))
-        for batch in route_sheets:
-            if batches[batch['entity_batch_id']]['order_id'] == order_id:
-                self.stop_batch(batch['identity'])
+    def stop_batches(self, identities, workers=None,
+                     complete_order_id=None):
+        """
+        Останавливает маршрутные листы в пуле из workers потоков.
+        Возвращает {identity: None или текст ошибки}. Если передан
+        complete_order_id и все остановки прошли успешно, завершает заказ.
+        """
+        report = {}
+        with ThreadPoolExecutor(
+                max_workers=workers or self.STOP_WORKERS
+        ) as executor:
+            futures = {
+                identity: executor.submit(self.stop_batch, identity)
+                for identity in identities
+            }
+            for identity, future in tqdm(
+                    futures.items(), desc='Останавливаем партии'
+            ):
+                try:
+                    response = future.result()
+                except RequestException as error:
+                    report[identity] = repr(error)
+                    continue
+                if isinstance(response, Response):
+                    report[identity] = 'Ответ не в формате JSON: ' \
+                                       '{!r}'.format(response)
+                else:
+                    report[identity] = None
+        failed = [
+            identity for identity, error in report.items() if error
+        ]
+        for identity in failed:
+            self._logger.error('Не удалось остановить маршрутный лист '
+                               '{!r}: {}'.format(identity, report[identity]))
+        if complete_order_id is not None:
+            if failed:
+                self._logger.error(
+                    'Заказ {} не завершен: не остановлено {} '
+                    'маршрутных листов'.format(complete_order_id, len(failed))
+                )
+            else:
+                self.complete_order(complete_order_id)
+        return report
+
+    def stop_all_batches(self, order_id, complete=False):
+        route_sheets = self._iter_rest_collection(
+            'entity_route_sheet',
+            f'&with=entity_batch&'
+            f'filter={{ entity_batch.order_id eq {order_id} }}'
+        )
+        return self.stop_batches(
+            [batch['identity'] for batch in route_sheets],
+            complete_order_id=order_id if complete else None
+        )
 
     def complete_order(self, order_id):
         return self._perform_action(
@@ -316,13 +696,35 @@ class CARest(Base):
             )
 
     @classmethod
-    def from_config(cls, config):
+    def from_config(cls, config, workers=None, **kwargs):
+        # в пуле должно хватать соединений на все потоки, которые
+        # одновременно работают через эту сессию
+        pool_size = config.get('pool_size') or max(
+            workers or 1, cls.PAGE_WORKERS, cls.STOP_WORKERS
+        )
+        compress_min_size = config.get('compress_min_size', 1024) \
+            if config.get('compress_requests') else None
+        http_session = make_session(
+            config['url'],
+            config['verify'],
+            pool_size=pool_size,
+            retries=config.get('retries', 3),
+            backoff=config.get('retry_backoff', 0.5),
+            safe_actions=config.get('retry_actions', SAFE_ACTIONS),
+            compress_min_size=compress_min_size
+        )
         return cls(
             config['login'],
             config['password'],
             config['url'],
             config['ws_url'],
-            config['verify']
+            config['verify'],
+            store=CollectionStore(config['store'])
+            if config.get('store') else None,
+            http_session=http_session,
+            log_payload_limit=config.get('log_payload_limit', 1000),
+            log_sample_rate=config.get('log_sample_rate', 1.0),
+            **kwargs
         )
 
 
@@ -0,0 +1,98 @@
+import json
+import sqlite3
+from datetime import datetime
+from threading import Lock
+
+from base.base import Base
+
+__all__ = [
+    'CollectionStore',
+]
+
+
+class CollectionStore(Base):
+    """
+    Локальная копия таблиц СА в SQLite. Для каждой таблицы хранится
+    максимальный загруженный id, чтобы при следующем запуске
+    догружать только новые строки. Число строк count сверяется с СА,
+    при расхождении таблица перезаписывается через replace. Правки
+    строк в СА копия не видит, для сравнения полей она не годится.
+    """
+
+    def __init__(self, path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS collection_row ('
+                'table_name TEXT, id INTEGER, data TEXT, '
+                'PRIMARY KEY (table_name, id))'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS collection_sync ('
+                'table_name TEXT PRIMARY KEY, high_water INTEGER, '
+                'synced_at TEXT)'
+            )
+
+    def close(self):
+        self._connection.close()
+
+    def high_water(self, table):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT high_water FROM collection_sync WHERE table_name = ?',
+                (table,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def load(self, table):
+        with self._lock:
+            return [
+                json.loads(data) for data, in self._connection.execute(
+                    'SELECT data FROM collection_row '
+                    'WHERE table_name = ? ORDER BY id',
+                    (table,)
+                )
+            ]
+
+    def count(self, table):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM collection_row WHERE table_name = ?',
+                (table,)
+            ).fetchone()[0]
+
+    def save(self, table, rows):
+        with self._lock, self._connection:
+            self._save(table, rows)
+
+    def replace(self, table, rows):
+        # строки удаляются в той же транзакции, что и записываются новые
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM collection_row WHERE table_name = ?', (table,)
+            )
+            self._connection.execute(
+                'DELETE FROM collection_sync WHERE table_name = ?', (table,)
+            )
+            self._save(table, rows)
+
+    def _save(self, table, rows):
+        high_water = self._connection.execute(
+            'SELECT high_water FROM collection_sync WHERE table_name = ?',
+            (table,)
+        ).fetchone()
+        high_water = -1 if high_water is None else high_water[0]
+        for row in rows:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO collection_row '
+                '(table_name, id, data) VALUES (?, ?, ?)',
+                (table, row['id'], json.dumps(row))
+            )
+            high_water = max(high_water, row['id'])
+        self._connection.execute(
+            'INSERT OR REPLACE INTO collection_sync '
+            '(table_name, high_water, synced_at) VALUES (?, ?, ?)',
+            (table, high_water, datetime.now().isoformat())
+        )
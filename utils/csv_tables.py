@@ -0,0 +1,87 @@
+import csv
+import re
+from datetime import datetime
+from os.path import isdir, isfile, join, splitext
+
+from utils.excel import iter_excel_sheets
+
+__all__ = [
+    'iter_input_sheets',
+]
+
+EXCEL_EXTENSIONS = ('.xlsx', '.xlsm')
+# числами считаем только обычную десятичную запись: int и float
+# приняли бы и nan, inf, 1_000, пробелы вокруг числа
+_INT_PATTERN = re.compile(r'[-+]?[0-9]+')
+_FLOAT_PATTERN = re.compile(
+    r'[-+]?([0-9]+\.[0-9]*|\.[0-9]+|[0-9]+(?=[eE]))([eE][-+]?[0-9]+)?'
+)
+# в CSV с разделителем ; (русский Excel) дробная часть отделяется запятой
+_COMMA_FLOAT_PATTERN = re.compile(r'[-+]?[0-9]+,[0-9]+')
+
+
+def iter_input_sheets(path, sheet_names):
+    """
+    Отдает пары (название листа, генератор строк-словарей) из книги Excel
+    или из каталога, где каждый лист лежит отдельным файлом
+    <название листа>.csv или <название листа>.parquet.
+    """
+    if isdir(path):
+        for name in sheet_names:
+            csv_path = join(path, f'{name}.csv')
+            parquet_path = join(path, f'{name}.parquet')
+            if isfile(csv_path):
+                yield name, iter_csv_rows(csv_path)
+            elif isfile(parquet_path):
+                yield name, iter_parquet_rows(parquet_path)
+    elif splitext(path)[1].lower() in EXCEL_EXTENSIONS:
+        yield from iter_excel_sheets(path, sheet_names)
+    else:
+        raise ValueError(f'Неизвестный формат входных данных: {path}')
+
+
+def _convert_value(value, decimal_comma=False):
+    # в CSV все строки, приводим к тем же типам, что отдает openpyxl
+    if value == '':
+        return None
+    # коды с ведущими нулями (номера операций и т.п.) оставляем строками
+    if len(value) > 1 and value[0] == '0' and value[1] != '.' and \
+            not (decimal_comma and value[1] == ','):
+        return value
+    if _INT_PATTERN.fullmatch(value):
+        return int(value)
+    if _FLOAT_PATTERN.fullmatch(value):
+        return float(value)
+    if decimal_comma and _COMMA_FLOAT_PATTERN.fullmatch(value):
+        return float(value.replace(',', '.'))
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+def iter_csv_rows(csv_path):
+    with open(csv_path, 'r', encoding='utf-8-sig', newline='') as csv_file:
+        try:
+            dialect = csv.Sniffer().sniff(csv_file.read(4096), ',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        csv_file.seek(0)
+        decimal_comma = dialect.delimiter == ';'
+        for row in csv.DictReader(csv_file, dialect=dialect):
+            yield {
+                key: _convert_value(value, decimal_comma)
+                for key, value in row.items()
+            }
+
+
+def iter_parquet_rows(parquet_path):
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            'Для чтения parquet-файлов нужно установить pyarrow'
+        )
+    parquet_file = pyarrow.parquet.ParquetFile(parquet_path)
+    for record_batch in parquet_file.iter_batches():
+        yield from record_batch.to_pylist()
@@ -7,11 +7,73 @@ from xml.etree.ElementTree import parse
 
 from tqdm import tqdm
 
-from utils.xml_tools import get_text_value, get_float_value, \
-    get_float_value_with_dot
+from utils.xml_tools import ElementFields, get_text_value, get_float_value
 from utils.entity import Entity
 
 
+class _MaterialTarget(object):
+    """
+    Цель XMLParser для потокового разбора файла материала. Элементы
+    дерева не создаются: поля MATERIALDATA, BOMHEADER, BOMITEM и
+    ROUTINGOPERATION собираются сразу в ElementFields и копятся
+    в events парами (тег, поля) до вызова pop_events. Как и find,
+    учитываются только первые разделы BOMDATA и ROUTINGDATA.
+    """
+    RECORDS = {
+        (): ('MATERIALDATA',),
+        ('BOMDATA',): ('BOMHEADER', 'BOMITEM'),
+        ('ROUTINGDATA',): ('ROUTINGOPERATION',),
+    }
+
+    def __init__(self):
+        self.events = []
+        self._path = []
+        self._done_sections = set()
+        self._fields = None
+        self._record_depth = None
+        self._text = None
+
+    def pop_events(self):
+        events, self.events = self.events, []
+        return events
+
+    def start(self, tag, attrib):
+        path = self._path
+        path.append(tag)
+        depth = len(path)
+        if self._fields is not None:
+            if depth == self._record_depth + 1:
+                self._text = []
+            else:
+                # текст поля -- только до первого вложенного элемента
+                self._text = None
+        elif depth in (2, 3) and \
+                tag in self.RECORDS.get(tuple(path[1:-1]), ()) and \
+                (depth == 2 or path[1] not in self._done_sections):
+            self._fields = ElementFields()
+            self._record_depth = depth
+
+    def data(self, text):
+        if self._text is not None:
+            self._text.append(text)
+
+    def end(self, tag):
+        path = self._path
+        depth = len(path)
+        if self._fields is not None:
+            if depth == self._record_depth + 1:
+                if tag not in self._fields:
+                    self._fields[tag] = ''.join(self._text) \
+                        if self._text else None
+                self._text = None
+            elif depth == self._record_depth:
+                self.events.append((tag, self._fields))
+                self._fields = None
+        elif depth == 2:
+            self._done_sections.add(tag)
+        path.pop()
+
+
 class ReadSession(object):
     def __init__(self):
         self.entities = {}
@@ -54,7 +116,208 @@ class ReadSession(object):
                         if answer == {}:
                             tqdm.write(full_path)
 
+    def _add_bom_item(self, parent, material, fields, items, base_quantity):
+        # fields -- ElementFields позиции BOMITEM
+        department = fields.text('ISSUE_LOC')
+        if department is not None:
+            if parent.department is None:
+                parent.department = department
+        if fields.text('AI_GROUP') is not None:
+            if fields.sap_float('USAGE_PROB') == 0:
+                return
+        category = fields.text('ITEM_CATEG')
+        component = fields.text('COMPONENT')
+        if category in ['X']:
+            if component in items:
+                tqdm.write(
+                    'Дубль номенклатуры {} в спецификации {}'.format(
+                        component,
+                        material.text('MATNR')
+                    )
+                )
+            else:
+                items.add(component)
+        if category in ['O', 'U', 'Y']:
+            return
+        child = self.add_entity(
+            code=component,
+            identity=None,
+            name=None,
+        )
+        try:
+            parent.spec[child] = fields.float_with_dot(
+                'COMP_QTY'
+            ) / base_quantity
+        except ValueError:
+            tqdm.write(
+                'Ошибка чтения количества в спецификации, '
+                'PARENT {}, CHILD {}'.format(
+                    parent.code, child.code
+                )
+            )
+
+    @staticmethod
+    def _route_operation(material, fields):
+        """
+        По ElementFields операции ROUTINGOPERATION возвращает
+        ('cycle', время цикла) для операции 9990, ('route', операция
+        маршрута, трудоемкость) или None, если операция в маршрут
+        не входит.
+        """
+        op_name = fields.text('LTXA1') or 'БЕЗ НАЗВАНИЯ'
+        op_name_upper = op_name.upper()
+        if 'КОНТРОЛЬ' in op_name_upper:
+            return None
+        if 'МАГНИТОПОРОШКОВАЯ ДЕФЕКТОСКОПИЯ' in op_name_upper:
+            return None
+        if 'КЛЕЙМЕНИЕ ОТК' in op_name_upper:
+            return None
+
+        nop = fields.text('VORNR')
+        if '9999' in nop:
+            return None
+        if '9990' in nop:
+            return 'cycle', fields.float_with_dot('VGW01') * 60
+        labor = fields.float_with_dot('VGW03') / \
+            fields.float_with_dot('BMSCH') * \
+            fields.float_with_dot('VGW06') / 100 * 60
+        return 'route', {
+            'IDENTITY': f"{material.text('MATNR')}_"
+                        f"{material.text('VERID')}_"
+                        f"{nop}",
+            'NOP': nop,
+            'NAME': op_name,
+            'T_SHT': round(labor, 4),
+            'EQUIPMENT_ID': fields.text('ARBID')
+        }, labor
+
+    def _add_material(self, material):
+        return self.add_entity(
+            code=material.text('MATNR').zfill(18),
+            identity=material.text('MEINS'),
+            name=material.text('MAKTX'),
+        )
+
+    @staticmethod
+    def _set_totals(parent, total_labor, cycle):
+        parent.labor = round(total_labor * 10000) / 10000
+        parent.cycle = round(cycle * 10000) / 10000
+
+    @staticmethod
+    def _iter_material_records(xml_file, chunk_size=64 * 1024):
+        # ставим utf-8 хардкодом, чтоб никаких неожиданностей не было
+        target = _MaterialTarget()
+        parser = XMLParser(target=target, encoding="utf-8")
+        while True:
+            chunk = xml_file.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            yield from target.pop_events()
+        parser.close()
+        yield from target.pop_events()
+
     def read_from_file(self, xml_file):
+        """
+        Потоковый разбор файла материала: файл читается частями, поля
+        BOMITEM и ROUTINGOPERATION собираются без построения дерева и
+        сразу применяются, память не зависит от размера документа.
+        Спецификация и маршрут собираются в черновой сессии и переносятся
+        в entities только после разбора всего документа, поэтому
+        оборванный файл, как и у read_from_file_tree, не оставляет
+        в сессии частичных данных.
+        """
+        report = {'result': 'good'}
+        draft = ReadSession()
+        material = None
+        parent = None
+        base_quantity = None
+        items = set()
+        # позиции, пришедшие раньше MATERIALDATA или BOMHEADER,
+        # разбираются в конце документа
+        pending_bom = []
+        pending_route = []
+        total_labor = 0
+        cycle = 0
+        try:
+            for tag, fields in self._iter_material_records(xml_file):
+                if tag == 'MATERIALDATA':
+                    if material is not None:
+                        continue
+                    material = fields
+                    if material.text('STATUS') == 'Z4':
+                        return report
+                    parent = draft._add_material(material)
+                elif tag == 'BOMHEADER':
+                    if base_quantity is None:
+                        base_quantity = fields.sap_float('BASE_QUAN')
+                elif tag == 'BOMITEM':
+                    if parent is None or base_quantity is None:
+                        pending_bom.append(fields)
+                    else:
+                        draft._add_bom_item(parent, material, fields, items,
+                                            base_quantity)
+                elif parent is None:
+                    pending_route.append(fields)
+                else:
+                    total_labor, cycle = draft._add_route_operation(
+                        parent, material, fields, total_labor, cycle
+                    )
+        except ParseError:
+            tqdm.write('Ошибка чтения файла {}'
+                       ' -- не распознан корень'.format(xml_file))
+            return {}
+
+        if material is None:
+            tqdm.write('Ошибка чтения файла -- не распознан MATERIALDATA')
+            return {}
+        for item in pending_bom:
+            draft._add_bom_item(parent, material, item, items, base_quantity)
+        for operation in pending_route:
+            total_labor, cycle = draft._add_route_operation(
+                parent, material, operation, total_labor, cycle
+            )
+        draft._set_totals(parent, total_labor, cycle)
+        self._merge_material(draft, parent)
+        return report
+
+    def _merge_material(self, draft, source):
+        # новые для сессии объекты переносятся из черновика как есть,
+        # к уже известным дописывается то же, что дописал бы разбор
+        # сразу в entities
+        for code, entity in draft.entities.items():
+            self.entities.setdefault(code, entity)
+        parent = self.entities[source.code]
+        if parent is not source:
+            if parent.identity is None:
+                parent.identity = source.identity
+                parent.name = source.name
+            if parent.department is None:
+                parent.department = source.department
+            parent.route.extend(source.route)
+            parent.labor = source.labor
+            parent.cycle = source.cycle
+        elif all(self.entities[child.code] is child for child in source.spec):
+            return
+        spec = list(source.spec.items())
+        if parent is source:
+            parent.spec.clear()
+        for child, amount in spec:
+            parent.spec[self.entities[child.code]] = amount
+
+    def _add_route_operation(self, parent, material, operation, total_labor,
+                             cycle):
+        entry = self._route_operation(material, operation)
+        if entry is None:
+            return total_labor, cycle
+        if entry[0] == 'cycle':
+            return total_labor, entry[1]
+        _, route_entry, labor = entry
+        parent.route.append(route_entry)
+        return total_labor + labor, cycle
+
+    def read_from_file_tree(self, xml_file):
+        # разбор с построением всего дерева документа
         # парсим xml
         try:
             # ставим utf-8 хардкодом, чтоб никаких неожиданностей не было
@@ -76,12 +339,9 @@ class ReadSession(object):
         if material is None:
             tqdm.write('Ошибка чтения файла -- не распознан MATERIALDATA')
             return {}
+        material = ElementFields(material)
 
-        parent = self.add_entity(
-            code=get_text_value(material, 'MATNR').zfill(18),
-            identity=get_text_value(material, 'MEINS'),
-            name=get_text_value(material, 'MAKTX'),
-        )
+        parent = self._add_material(material)
 
         bom = root.find('BOMDATA')
 
@@ -90,87 +350,21 @@ class ReadSession(object):
             base_quantity = get_float_value(bom.find('BOMHEADER'), 'BASE_QUAN')
             items = set()
             for item in bom_items:
-                if get_text_value(item, 'ISSUE_LOC') is not None:
-                    department = get_text_value(item, 'ISSUE_LOC')
-                    if parent.department is None:
-                        parent.department = department
-                if get_text_value(item, 'AI_GROUP') is not None:
-                    if get_float_value(item, 'USAGE_PROB') == 0:
-                        continue
-                if get_text_value(item, 'ITEM_CATEG') in ['X']:
-                    if get_text_value(item, 'COMPONENT') in items:
-                        tqdm.write(
-                            'Дубль номенклатуры {} в спецификации {}'.format(
-                                get_text_value(item, 'COMPONENT'),
-                                get_text_value(material, 'MATNR')
-                            )
-                        )
-                    else:
-                        items.add(get_text_value(item, 'COMPONENT'))
-                if get_text_value(item, 'ITEM_CATEG') in ['O', 'U', 'Y']:
-                    continue
-                child = self.add_entity(
-                    code=get_text_value(item, 'COMPONENT'),
-                    identity=None,
-                    name=None,
-                )
-                try:
-                    parent.spec[child] = get_float_value_with_dot(
-                        item, 'COMP_QTY'
-                    ) / base_quantity
-                except ValueError:
-                    tqdm.write(
-                        'Ошибка чтения количества в спецификации, '
-                        'PARENT {}, CHILD {}'.format(
-                            parent.code, child.code
-                        )
-                    )
+                self._add_bom_item(parent, material, ElementFields(item),
+                                   items, base_quantity)
         route = root.find('ROUTINGDATA')
-        if '1354D0000015-A0721' in parent.code:
-            a = 1
 
         total_labor = 0
         cycle = 0
         if route:
             route_operations = route.findall('ROUTINGOPERATION')
             for operation in route_operations:
-                op_name = get_text_value(operation, 'LTXA1') or 'БЕЗ НАЗВАНИЯ'
-                if 'КОНТРОЛЬ' in \
-                        op_name.upper():
-                    continue
-                if 'МАГНИТОПОРОШКОВАЯ ДЕФЕКТОСКОПИЯ' in \
-                        op_name.upper():
-                    continue
-                if 'КЛЕЙМЕНИЕ ОТК' in \
-                        op_name.upper():
-                    continue
-
-                if '9999' in get_text_value(operation, 'VORNR'):
-                    continue
-                if '9990' in get_text_value(operation, 'VORNR'):
-                    cycle = get_float_value_with_dot(
-                            operation, 'VGW01'
-                        ) * 60
-                    continue
-                parent.route.append({
-                    'IDENTITY': f"{get_text_value(material, 'MATNR')}_"
-                                f"{get_text_value(material, 'VERID')}_"
-                                f"{get_text_value(operation, 'VORNR')}",
-                    'NOP': get_text_value(operation, 'VORNR'),
-                    'NAME': op_name,
-                    'T_SHT': round(get_float_value_with_dot(
-                        operation, 'VGW03') / get_float_value_with_dot(
-                        operation, 'BMSCH') * get_float_value_with_dot(
-                        operation, 'VGW06') / 100 * 60, 4),
-                    'EQUIPMENT_ID': get_text_value(operation, 'ARBID')
-                })
-                total_labor += get_float_value_with_dot(
-                    operation, 'VGW03') / get_float_value_with_dot(
-                    operation, 'BMSCH') * get_float_value_with_dot(
-                    operation, 'VGW06') / 100 * 60
+                total_labor, cycle = self._add_route_operation(
+                    parent, material, ElementFields(operation), total_labor,
+                    cycle
+                )
 
-        parent.labor = round(total_labor * 10000) / 10000
-        parent.cycle = round(cycle * 10000) / 10000
+        self._set_totals(parent, total_labor, cycle)
 
         return report
 
@@ -1,30 +1,49 @@
 import openpyxl
 
 
-def excel_to_dict(excel_path):
-    # Load the workbook
-    workbook = openpyxl.load_workbook(excel_path)
-
-    # Select the first sheet
-    book = {}
-    for worksheet in workbook:
-        if worksheet.title[0] == '#':
-            continue
-
-        # Get the header row as a list
-        header = [cell.value for cell in worksheet[1]]
-
-        # Initialize an empty list to store the dictionaries
-        book[worksheet.title] = []
-
-        # Loop through the rows and create a dictionary for each row
-        for row in worksheet.iter_rows(min_row=2, values_only=True):
-            row_data = {}
-            for j in range(len(header)):
-                row_data[header[j]] = row[j]
-            book[worksheet.title].append(row_data)
-
-    return book
+def iter_excel_sheets(excel_path, sheet_names=None):
+    """
+    Потоково читает книгу (read-only, только значения) и для каждого
+    нужного листа отдает пару (название, генератор строк-словарей).
+    Строки листа нужно прочитать до перехода к следующему листу.
+    """
+    # Load the workbook without building the cell object model
+    workbook = openpyxl.load_workbook(
+        excel_path, read_only=True, data_only=True
+    )
+    try:
+        for worksheet in workbook:
+            if worksheet.title[0] == '#':
+                continue
+            if sheet_names is not None and \
+                    worksheet.title not in sheet_names:
+                continue
+            yield worksheet.title, _iter_worksheet_rows(worksheet)
+    finally:
+        workbook.close()
+
+
+def _iter_worksheet_rows(worksheet):
+    rows = worksheet.iter_rows(values_only=True)
+
+    # Get the header row as a list
+    header = next(rows, None)
+    if header is None:
+        return
+
+    # Loop through the rows and create a dictionary for each row
+    width = len(header)
+    for row in rows:
+        if len(row) < width:
+            row = row + (None,) * (width - len(row))
+        yield dict(zip(header, row))
+
+
+def excel_to_dict(excel_path, sheet_names=None):
+    return {
+        title: list(rows)
+        for title, rows in iter_excel_sheets(excel_path, sheet_names)
+    }
 
 
 def dict_to_excel(data, path: str) -> None:
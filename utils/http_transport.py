@@ -0,0 +1,85 @@
+import gzip
+from urllib.parse import urljoin
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+__all__ = [
+    'CompressingAdapter',
+    'SAFE_ACTIONS',
+    'make_session',
+]
+
+# ответы шлюза, после которых запрос имеет смысл повторить
+RETRY_STATUSES = (429, 502, 503, 504)
+# действия, повторная отправка которых не меняет результат
+SAFE_ACTIONS = (
+    'login',
+    'entity_batch/stop',
+)
+
+
+class CompressingAdapter(HTTPAdapter):
+    """
+    HTTPAdapter, сжимающий gzip тела запросов длиннее compress_min_size
+    байт. При compress_min_size=None тела отправляются как есть.
+    """
+
+    def __init__(self, *args, compress_min_size=None, **kwargs):
+        self._compress_min_size = compress_min_size
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        body = request.body
+        if self._compress_min_size is not None and body and \
+                'Content-Encoding' not in request.headers and \
+                len(body) >= self._compress_min_size:
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            request.body = gzip.compress(body, compresslevel=5)
+            request.headers['Content-Encoding'] = 'gzip'
+            request.headers['Content-Length'] = str(len(request.body))
+        return super().send(request, **kwargs)
+
+
+def _retry(retries, backoff, methods):
+    return Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(methods),
+        # после последней попытки отдаем ответ как есть, его разбирает
+        # _perform_json_request
+        raise_on_status=False,
+    )
+
+
+def make_session(base_url, verify, pool_size=10, retries=3, backoff=0.5,
+                 safe_actions=SAFE_ACTIONS, compress_min_size=None):
+    """
+    Создает requests.Session для СА: пул на pool_size соединений,
+    повтор GET и безопасных действий action/* с экспоненциальной
+    задержкой, gzip-сжатие больших тел запросов. Сжатые ответы
+    requests принимает и распаковывает сам.
+    """
+    session = Session()
+    session.verify = verify
+
+    def adapter(methods):
+        return CompressingAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=_retry(retries, backoff, methods),
+            compress_min_size=compress_min_size
+        )
+
+    # rest/{model} POST создает объекты, его повтор породит дубли,
+    # поэтому POST повторяется только для перечисленных действий
+    session.mount(base_url, adapter(['GET', 'HEAD']))
+    for action in safe_actions:
+        session.mount(
+            urljoin(base_url, f'action/{action}'),
+            adapter(['GET', 'HEAD', 'POST'])
+        )
+    return session
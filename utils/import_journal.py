@@ -0,0 +1,69 @@
+import json
+from os.path import exists
+from threading import Lock
+
+__all__ = [
+    'ImportJournal',
+]
+
+
+class ImportJournal(object):
+    """
+    Журнал импорта: по строке JSON на каждый созданный или найденный
+    объект (модель, ключ, id) и на каждую партию, по которой отправлено
+    websocket-сообщение. При resume=True журнал дочитывается и
+    продолжается, иначе начинается заново.
+    """
+
+    def __init__(self, path, resume=False):
+        self._lock = Lock()
+        self.ids = {}
+        self.started = set()
+        complete = True
+        if resume and exists(path):
+            complete = self._load(path)
+        self._file = open(
+            path, 'a' if resume else 'w', encoding='utf-8'
+        )
+        if not complete:
+            self._file.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load(self, path):
+        line = '\n'
+        with open(path, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # последняя строка могла не дописаться при падении
+                    continue
+                self.ids[(entry['model'], entry['identity'])] = entry['id']
+                if entry['websocket_sent']:
+                    self.started.add(entry['identity'])
+        return line.endswith('\n')
+
+    def record(self, model, identity, object_id, websocket_sent=False):
+        line = json.dumps(
+            {
+                'model': model,
+                'identity': identity,
+                'id': object_id,
+                'websocket_sent': websocket_sent
+            },
+            ensure_ascii=False
+        )
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            self.ids[(model, identity)] = object_id
+            if websocket_sent:
+                self.started.add(identity)
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,39 @@
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+__all__ = [
+    'ijson',
+    'read_collection_page',
+]
+
+
+def read_collection_page(stream, table):
+    """
+    Разбирает страницу rest/collection/{table} по мере чтения из stream:
+    строки массива table собираются по одной, тело ответа целиком
+    в памяти не держится. Возвращает {'meta': {'count': ...},
+    table: [...]}, остальные ключи ответа пропускаются.
+    """
+    page = {'meta': {}}
+    item_prefix = f'{table}.item'
+    builder = None
+    # use_float: числа как float, а не Decimal -- так же, как json.loads
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == item_prefix and event in ('end_map', 'end_array'):
+                page[table].append(builder.value)
+                builder = None
+        elif prefix == item_prefix:
+            if event in ('start_map', 'start_array'):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            else:
+                page[table].append(value)
+        elif prefix == table and event == 'start_array':
+            page[table] = []
+        elif prefix == 'meta.count':
+            page['meta']['count'] = value
+    return page
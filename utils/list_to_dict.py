@@ -1,6 +1,22 @@
+from collections import defaultdict
+from operator import itemgetter
+
+
+def _key_getter(key_column):
+    # 'PARENT_CODE|CODE' -> ключ-кортеж (PARENT_CODE, CODE)
+    return itemgetter(*key_column.split('|'))
+
+
 def list_to_dict(list_data, key_column='id'):
-    report = dict()
+    # строки не копируются, в словаре лежат ссылки на исходные строки
+    get_key = _key_getter(key_column)
+    return {get_key(row): row for row in list_data}
+
+
+def group_list(list_data, key_column):
+    get_key = _key_getter(key_column)
+    report = defaultdict(list)
     for row in list_data:
-        report[row[key_column]] = {key: value for key, value in row.items()}
+        report[get_key(row)].append(row)
 
     return report
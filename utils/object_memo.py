@@ -0,0 +1,93 @@
+from collections import Counter
+from threading import Lock
+
+__all__ = [
+    'ObjectMemo',
+]
+
+
+class ObjectMemo(object):
+    """
+    Запоминает id объектов СА, созданных или найденных за время импорта,
+    по ключу (модель, значение ключевого поля), чтобы каждый объект
+    запрашивался у СА не больше одного раза.
+    Безопасен для использования из нескольких потоков: копии, полученные
+    через for_session, работают со своей сессией, но общими id.
+    Если передан journal, id из него используются без запросов к СА,
+    а новые id дописываются в журнал.
+    """
+
+    def __init__(self, ca_session, ids=None, lock=None, stats=None,
+                 journal=None):
+        self._session = ca_session
+        self._lock = lock or Lock()
+        self._stats = Counter() if stats is None else stats
+        self._journal = journal
+        if ids is None:
+            ids = {} if journal is None else dict(journal.ids)
+        self.ids = ids
+
+    @property
+    def avoided(self):
+        return self._stats['avoided']
+
+    def for_session(self, ca_session):
+        return ObjectMemo(
+            ca_session, self.ids, self._lock, self._stats, self._journal
+        )
+
+    def _remember(self, key, object_id):
+        object_id = self.ids.setdefault(key, object_id)
+        if self._journal is not None:
+            self._journal.record(key[0], key[1], object_id)
+        return object_id
+
+    def record_sent(self, model, identity, object_id):
+        # в журнал: по объекту отправлено websocket-сообщение
+        if self._journal is not None:
+            self._journal.record(
+                model, identity, object_id, websocket_sent=True
+            )
+
+    def covers(self, model, rows):
+        # id всех строк уже известны -- к СА по модели обращаться не нужно
+        with self._lock:
+            return all(self._key(model, row) in self.ids for row in rows)
+
+    def _key(self, model, row):
+        return model, str(row[self._session._check_column(model)])
+
+    def create_object(self, model, data):
+        key = self._key(model, data)
+        with self._lock:
+            if key in self.ids:
+                self._stats['avoided'] += 1
+                return self.ids[key]
+        object_id = self._session.create_object(model, data)
+        with self._lock:
+            return self._remember(key, object_id)
+
+    def create_objects(self, model, rows, **kwargs):
+        check_value = self._session._check_column(model)
+        report = {}
+        to_resolve = {}
+        with self._lock:
+            for row in rows:
+                key = self._key(model, row)
+                if key in self.ids:
+                    self._stats['avoided'] += 1
+                    report[row[check_value]] = self.ids[key]
+                elif key in to_resolve:
+                    self._stats['avoided'] += 1
+                else:
+                    to_resolve[key] = row
+        if to_resolve:
+            created = self._session.create_objects(
+                model, to_resolve.values(), **kwargs
+            )
+            with self._lock:
+                for key, row in to_resolve.items():
+                    report[row[check_value]] = self._remember(
+                        key, created[row[check_value]]
+                    )
+        return report
@@ -1,22 +1,61 @@
-import json
 import sys
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import closing
-from xml.etree.ElementTree import XMLParser, parse, ParseError
+from io import BytesIO
+from multiprocessing import freeze_support
+from operator import attrgetter
+from queue import Queue
+from stat import S_ISDIR
+from xml.etree.ElementTree import XMLParser, iterparse, parse, ParseError
 
 import paramiko
 from tqdm import tqdm
 
-from utils.xml_tools import get_text_value, get_float_value_with_dot
+from utils.body_manifest import BodyManifest
+from utils.xml_tools import ElementFields
 
 
 class KKFtpReader:
-    def __init__(self, last_path, ftp_session):
+    def __init__(self, last_path, ftp_session, ssh_client=None, channels=1,
+                 manifest=None, recheck_bodies=False, parse_workers=2,
+                 window=None):
         self.last_path = last_path
         self.ftp_client = ftp_session
+        # BodyManifest: какие body уже разобраны, при нем last_path
+        # можно не задавать
+        self.manifest = manifest
+        # body, перезаписанный на месте, не меняет mtime каталога;
+        # чтобы его заметить, каталоги запросов листаются всегда
+        self.recheck_bodies = recheck_bodies
+        # содержимое каталогов, прочитанное заранее или при проверке
+        # на вложенные каталоги, -- чтобы не запрашивать его повторно
+        self._listings = {}
+        # каталоги листаются одновременно через channels каналов SFTP
+        # одного ssh-соединения
+        self._own_channels = [
+            ssh_client.open_sftp() for _ in range(channels - 1)
+        ] if ssh_client is not None else []
+        self._channels = Queue()
+        for channel in [ftp_session] + self._own_channels:
+            self._channels.put(channel)
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self._own_channels) + 1
+        ) if self._own_channels else None
+        # при нескольких каналах body загружаются заранее в их потоках,
+        # а разбираются в parse_workers процессах: разбор XML держит GIL
+        # и в потоках не распараллеливается
+        self._parse_executor = ProcessPoolExecutor(
+            max_workers=parse_workers
+        ) if self._own_channels else None
+        self.window = window or 4 * (len(self._own_channels) + 1)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        ...
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._parse_executor.shutdown()
+        for channel in self._own_channels:
+            channel.close()
         # with open('last_path.json', 'w', encoding='utf-8') as input_file:
         #     json.dump(
         #         self.last_path,
@@ -26,115 +65,282 @@ class KKFtpReader:
     def __enter__(self):
         return self
 
-    def read_from_ftp(self, path_to_iter):
-        report = []
-        for i in sorted(
-                self.ftp_client.listdir(
-                    path=path_to_iter
+    def _list_dir(self, path):
+        listing = self._listings.get(path)
+        if listing is None:
+            channel = self._channels.get()
+            try:
+                # имена и атрибуты одним запросом на каталог
+                listing = sorted(
+                    channel.listdir_attr(path=path),
+                    key=attrgetter('filename')
                 )
+            finally:
+                self._channels.put(channel)
+            self._listings[path] = listing
+        return listing
+
+    def _prefetch_listings(self, paths):
+        if self._executor is None:
+            return
+        for _ in self._executor.map(
+                self._list_dir,
+                [path for path in paths if path not in self._listings]
         ):
-            lstatout = str(self.ftp_client.lstat(
-                '{}/{}'.format(path_to_iter, i)
-            )).split()[0]
-            if 'd' in lstatout:
-                report.append('{}/{}'.format(path_to_iter, i))
-        return report
+            pass
 
-    def read_tech_from_ftp(self, path_to_iter):
+    def _subdirs(self, path):
+        return [
+            ('{}/{}'.format(path, attr.filename), attr)
+            for attr in self._list_dir(path)
+            if S_ISDIR(attr.st_mode)
+        ]
+
+    def _body_attr(self, path):
+        for attr in self._list_dir(path):
+            if attr.filename == 'body':
+                return attr
+        return None
+
+    def read_from_ftp(self, path_to_iter):
+        return [each_path for each_path, _ in self._subdirs(path_to_iter)]
+
+    def _iter_request_dirs(self, path_to_iter):
+        # каталоги запросов, которые не менялись с прошлого разбора,
+        # по манифесту пропускаются без листинга
+        skip_current = self.manifest is not None and not self.recheck_bodies
+        subdirs = [
+            (each_path, attr)
+            for each_path, attr in self._subdirs(path_to_iter)
+            if not each_path < self.last_path[:len(each_path)] and not (
+                skip_current and
+                self.manifest.is_current(each_path, attr.st_mtime)
+            )
+        ]
+        self._listings.pop(path_to_iter, None)
+        self._prefetch_listings([each_path for each_path, _ in subdirs])
         iter1 = tqdm(
-            sorted(self.read_from_ftp(path_to_iter)),
+            subdirs,
             desc=path_to_iter,
             file=sys.stdout,
             position=0
         )
-        for each_path in iter1:
+        for each_path, attr in iter1:
             if each_path < self.last_path[:len(each_path)]:
                 continue
             if self.read_from_ftp(each_path):
-                look_for_files = self.read_tech_from_ftp(each_path)
-                for i in look_for_files:
-                    yield i
+                yield from self._iter_request_dirs(each_path)
                 continue
+            body = self._body_attr(each_path)
+            self._listings.pop(each_path, None)
             self.last_path = each_path
-            report = self.read_file_from_ftp(each_path)
+            if body is not None and self.manifest is not None and \
+                    self.manifest.is_processed(
+                        each_path, body.st_size, body.st_mtime
+                    ):
+                # изменился только каталог, body уже разобран
+                self.manifest.record(
+                    each_path, attr.st_mtime, body.st_size, body.st_mtime,
+                    self.manifest.entries[each_path]['outcome']
+                )
+                continue
+            yield each_path, attr, body
+
+    def _fetch_and_parse(self, path, body):
+        # выполняется в потоке загрузки: скачивает body по свободному
+        # каналу и отдает разбор в пул обработчиков
+        channel = self._channels.get()
+        try:
+            with closing(channel.open('{}/body'.format(path))) as f:
+                if body is not None:
+                    # запросы на чтение частей файла идут конвейером
+                    f.prefetch(body.st_size)
+                content = f.read()
+        except FileNotFoundError:
+            tqdm.write(f'Файл не найден {path}/body')
+            return None
+        finally:
+            self._channels.put(channel)
+        return self._parse_executor.submit(_parse_body_content, content)
+
+    def _iter_reports(self, request_dirs):
+        if self._executor is None:
+            for each_path, attr, body in request_dirs:
+                yield each_path, attr, body, self.read_file_from_ftp(each_path)
+            return
+        # не больше window документов загружается и разбирается вперед,
+        # результаты отдаются в порядке обхода
+        pending = deque()
+        for request_dir in request_dirs:
+            each_path, _, body = request_dir
+            pending.append((request_dir, self._executor.submit(
+                self._fetch_and_parse, each_path, body
+            )))
+            if len(pending) >= self.window:
+                yield self._pop_report(pending)
+        while pending:
+            yield self._pop_report(pending)
+
+    @staticmethod
+    def _pop_report(pending):
+        request_dir, future = pending.popleft()
+        parse_future = future.result()
+        report = parse_future.result() if parse_future is not None else None
+        return request_dir + (report,)
+
+    def read_tech_from_ftp(self, path_to_iter):
+        for each_path, attr, body, report in self._iter_reports(
+                self._iter_request_dirs(path_to_iter)
+        ):
             if report:
                 yield {' '.join(each_path.split('/')[-3:-1]): report}
                 # report[' '.join(each_path.split('/')[-3:-1])] = report
+            # документ отмечается обработанным после того, как
+            # получатель забрал отчет
+            if body is not None and self.manifest is not None:
+                self.manifest.record(
+                    each_path, attr.st_mtime, body.st_size, body.st_mtime,
+                    'report' if report else 'skipped'
+                )
 
     def read_file_from_ftp(self, path):
         try:
             with closing(self.ftp_client.open('{}/body'.format(path))) as f:
-                # парсим xml
-                try:
-                    # ставим utf-8 хардкодом, чтоб
-                    # никаких неожиданностей не было
-                    xmlp = XMLParser(encoding="utf-8")
-                    tree = parse(f, parser=xmlp)
-                    root = tree.getroot()
-                except ParseError:
-                    tqdm.write('Ошибка чтения файла -- не распознан корень')
-                    return
-                header = root.find('Header')
-                if header is None:
-                    tqdm.write(
-                        'Ошибка чтения файла -- не распознан Header')
-                    return
-                items = root.findall('Items')
-                if items is None:
-                    tqdm.write(
-                        'Ошибка чтения файла -- не распознан Items')
-                    return
-                report = {
-                    'DOCUMENT': get_text_value(header, 'MBLNR'),
-                    'RECEIVED': defaultdict(float),
-                    'DONE': defaultdict(float),
-                    'DELIVERED': defaultdict(float)
-                }
-                check = False
-                for item in items:
-                    # если вид движения 301/311 и адресат -- 1072,
-                    # то считаем сумму и запускаем партии
-                    is_receive = get_text_value(item, 'BWART') in ['301', '311']
-                    is_recepient = get_text_value(item, 'UMLGO') == '1072'
-                    if is_receive and is_recepient:
-                        report['DEPARTMENT'] = get_text_value(item, 'LGORT')
-                        report['RECEIVED'][get_text_value(item, 'UMMAT')] += \
-                            get_float_value_with_dot(item, 'ERFMG')
-                        check = True
-
-                    # если вид движения 301/311 и отправитель -- 1072,
-                    # то считаем сумму и закрываем партии, которые в статусе "обработка завершена"
-                    is_send = get_text_value(item, 'BWART') in ['301', '311']
-                    is_sender = get_text_value(item, 'LGORT') == '1072'
-                    if is_send and is_sender:
-                        report['DELIVERED'][get_text_value(item, 'MATNR')] += \
-                            get_float_value_with_dot(item, 'ERFMG')
-                        check = True
-
-                    # если вид движения 101 и исполнитель -- 1072,
-                    # то считаем сумму и закрываем "обработка завершена" по партии
-                    is_done = get_text_value(item, 'BWART') == '101'
-                    is_executor = get_text_value(item, 'UMLGO') == '1072'
-                    if is_done and is_executor:
-                        report['DONE'][get_text_value(item, 'UMMAT')] += \
-                            get_float_value_with_dot(item, 'ERFMG')
-                        check = True
-
+                return self.parse_body(f)
         except FileNotFoundError:
             tqdm.write(f'Файл не найден {path}/body')
+
+    @staticmethod
+    def _add_item(report, item):
+        fields = ElementFields(item)
+        movement_type = fields.text('BWART')
+        recipient = fields.text('UMLGO')
+        storage = fields.text('LGORT')
+        check = False
+        # если вид движения 301/311 и адресат -- 1072,
+        # то считаем сумму и запускаем партии
+        is_receive = movement_type in ['301', '311']
+        is_recepient = recipient == '1072'
+        if is_receive and is_recepient:
+            report['DEPARTMENT'] = storage
+            report['RECEIVED'][fields.text('UMMAT')] += \
+                fields.float_with_dot('ERFMG')
+            check = True
+
+        # если вид движения 301/311 и отправитель -- 1072,
+        # то считаем сумму и закрываем партии, которые в статусе "обработка завершена"
+        is_send = movement_type in ['301', '311']
+        is_sender = storage == '1072'
+        if is_send and is_sender:
+            report['DELIVERED'][fields.text('MATNR')] += \
+                fields.float_with_dot('ERFMG')
+            check = True
+
+        # если вид движения 101 и исполнитель -- 1072,
+        # то считаем сумму и закрываем "обработка завершена" по партии
+        is_done = movement_type == '101'
+        is_executor = recipient == '1072'
+        if is_done and is_executor:
+            report['DONE'][fields.text('UMMAT')] += \
+                fields.float_with_dot('ERFMG')
+            check = True
+        return check
+
+    @staticmethod
+    def _new_report(document):
+        return {
+            'DOCUMENT': document,
+            'RECEIVED': defaultdict(float),
+            'DONE': defaultdict(float),
+            'DELIVERED': defaultdict(float)
+        }
+
+    @classmethod
+    def parse_body(cls, f):
+        """
+        Потоковый разбор body: каждый Items обрабатывается по окончании
+        и сразу удаляется из дерева, память не зависит от размера
+        документа. Результат тот же, что у parse_body_tree.
+        """
+        header = None
+        report = cls._new_report(None)
+        check = False
+        depth = 0
+        root = None
+        try:
+            # ставим utf-8 хардкодом, чтоб
+            # никаких неожиданностей не было
+            for event, element in iterparse(
+                    f,
+                    events=('start', 'end'),
+                    parser=XMLParser(encoding="utf-8")
+            ):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                # прямой потомок корня разобран целиком
+                if element.tag == 'Header':
+                    if header is None:
+                        header = element
+                        continue
+                elif element.tag == 'Items':
+                    check = cls._add_item(report, element) or check
+                root.remove(element)
+        except ParseError:
+            tqdm.write('Ошибка чтения файла -- не распознан корень')
+            return
+        if header is None:
+            tqdm.write(
+                'Ошибка чтения файла -- не распознан Header')
+            return
+        report['DOCUMENT'] = ElementFields(header).text('MBLNR')
         if check:
             return report
 
+    @classmethod
+    def parse_body_tree(cls, f):
+        # разбор с построением всего дерева документа
+        # парсим xml
+        try:
+            # ставим utf-8 хардкодом, чтоб
+            # никаких неожиданностей не было
+            xmlp = XMLParser(encoding="utf-8")
+            tree = parse(f, parser=xmlp)
+            root = tree.getroot()
+        except ParseError:
+            tqdm.write('Ошибка чтения файла -- не распознан корень')
+            return
+        header = root.find('Header')
+        if header is None:
+            tqdm.write(
+                'Ошибка чтения файла -- не распознан Header')
+            return
+        items = root.findall('Items')
+        if items is None:
+            tqdm.write(
+                'Ошибка чтения файла -- не распознан Items')
+            return
+        report = cls._new_report(ElementFields(header).text('MBLNR'))
+        check = False
+        for item in items:
+            check = cls._add_item(report, item) or check
+        if check:
+            return report
 
-if __name__ == '__main__':
 
-    try:
-        with open('last_path.json', 'r', encoding='utf-8') as input_file:
-            last_path = json.load(
-                input_file
-            )
-    except FileNotFoundError:
-        last_path = ''
+def _parse_body_content(content):
+    # выполняется в процессе пула разбора, body передается байтами
+    return KKFtpReader.parse_body(BytesIO(content))
+
+
+if __name__ == '__main__':
+    # пул разбора на процессах в собранном PyInstaller exe
+    freeze_support()
 
     sftpURL = 'kk-srv-bfg2.npo.izhmash'
     sftpUser = 'a.a.stolov'
@@ -148,11 +354,10 @@ if __name__ == '__main__':
         password=sftpPass
     )
 
-    with closing(client) as ssh:
+    with closing(client) as ssh, \
+            BodyManifest('body_manifest.json') as manifest:
         with closing(ssh.open_sftp()) as ftp:
-            with KKFtpReader(last_path, ftp) as ftp_session:
-                path_list = ftp_session.read_from_ftp(sftpPath)
-                for path in path_list:
-                    if path < last_path[:len(path)]:
-                        continue
-                    ftp_session.read_tech_from_ftp(path)
+            with KKFtpReader('', ftp, ssh, channels=4,
+                             manifest=manifest) as ftp_session:
+                for document in ftp_session.read_tech_from_ftp(sftpPath):
+                    tqdm.write(str(document))
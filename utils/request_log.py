@@ -0,0 +1,78 @@
+from logging import DEBUG
+from random import random
+from reprlib import Repr
+from uuid import uuid4
+
+__all__ = [
+    'RequestLog',
+    'TruncatedRepr',
+]
+
+
+class TruncatedRepr(object):
+    """
+    Отложенный repr: строится только при форматировании записи лога
+    и обрезается до limit символов.
+    """
+    __slots__ = ('_value', '_limit')
+
+    def __init__(self, value, limit):
+        self._value = value
+        self._limit = limit
+
+    def __repr__(self):
+        if self._limit is None:
+            return repr(self._value)
+        # reprlib не обходит вложенные структуры целиком, поэтому
+        # обрезка большой страницы не стоит полного repr
+        short_repr = Repr()
+        short_repr.maxstring = short_repr.maxother = self._limit
+        short_repr.maxlist = short_repr.maxdict = max(1, self._limit // 20)
+        text = short_repr.repr(self._value)
+        if len(text) > self._limit:
+            return f'{text[:self._limit]}... ({len(text)} символов)'
+        return text
+
+    __str__ = __repr__
+
+
+class RequestLog(object):
+    """
+    Логирование запросов к СА: у каждого запроса свой идентификатор
+    request_id, он же передается в extra записей. Тела запросов и
+    ответов пишутся в debug только для доли sample_rate запросов и
+    обрезаются до payload_limit символов; repr строится лениво.
+    """
+
+    def __init__(self, logger, payload_limit=1000, sample_rate=1.0):
+        self._logger = logger
+        self.payload_limit = payload_limit
+        self.sample_rate = sample_rate
+
+    def start(self, http_method, url):
+        extra = {
+            'request_id': uuid4().hex[:12],
+            'http_method': http_method,
+            'url': url,
+        }
+        self._logger.info('[%s] Выполнение %s запроса по ссылке %r.',
+                          extra['request_id'], http_method, url,
+                          extra=extra)
+        # решение о записи тел принимается один раз на запрос, чтобы
+        # запрос и ответ попадали в лог парой
+        extra['sampled'] = self._logger.isEnabledFor(DEBUG) and \
+            (self.sample_rate >= 1 or random() < self.sample_rate)
+        return extra
+
+    def payload(self, extra, message, payload):
+        if extra['sampled']:
+            self._logger.debug('[%s] %s: %r.', extra['request_id'], message,
+                               TruncatedRepr(payload, self.payload_limit),
+                               extra=extra)
+
+    def error(self, extra, response):
+        self._logger.error('[%s] Получен ответ на %s запрос по ссылке %r: '
+                           '%r', extra['request_id'], extra['http_method'],
+                           extra['url'],
+                           TruncatedRepr(response, self.payload_limit),
+                           extra=extra)
@@ -0,0 +1,148 @@
+import json
+import re
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from tqdm import tqdm
+
+__all__ = [
+    'RequestMetrics',
+    'measure_phase',
+]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+class RequestMetrics(object):
+    """
+    Счетчики запросов к СА по (HTTP-метод, шаблон ссылки): число запросов,
+    ошибок, отправленные и полученные байты и гистограмма задержек.
+    Один объект можно разделять между несколькими сессиями и потоками.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._endpoints = {}
+        self.phases = {}
+
+    @staticmethod
+    def endpoint_template(uri):
+        path = '/' + urlsplit(uri).path.strip('/')
+        return _ID_SEGMENT.sub('/{id}', path)
+
+    def record(self, http_method, uri, latency, bytes_sent=0,
+               bytes_received=0, error=False):
+        key = (http_method, self.endpoint_template(uri))
+        with self._lock:
+            endpoint = self._endpoints.get(key)
+            if endpoint is None:
+                endpoint = self._endpoints[key] = {
+                    'count': 0,
+                    'errors': 0,
+                    'bytes_sent': 0,
+                    'bytes_received': 0,
+                    'latency_sum': 0.0,
+                    'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                }
+            endpoint['count'] += 1
+            endpoint['errors'] += int(error)
+            endpoint['bytes_sent'] += bytes_sent
+            endpoint['bytes_received'] += bytes_received
+            endpoint['latency_sum'] += latency
+            endpoint['latency_buckets'][
+                bisect_left(LATENCY_BUCKETS, latency)
+            ] += 1
+
+    def record_phase(self, name, seconds, requests):
+        with self._lock:
+            self.phases[name] = {
+                'seconds': seconds,
+                'requests': requests,
+            }
+
+    def total_requests(self):
+        with self._lock:
+            return sum(
+                endpoint['count'] for endpoint in self._endpoints.values()
+            )
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'endpoints': [
+                    dict(
+                        endpoint,
+                        method=method,
+                        endpoint=template,
+                        latency_buckets=list(endpoint['latency_buckets'])
+                    )
+                    for (method, template), endpoint
+                    in sorted(self._endpoints.items())
+                ],
+                'latency_bucket_bounds': list(LATENCY_BUCKETS),
+                'phases': dict(self.phases),
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self):
+        lines = []
+        snapshot = self.snapshot()
+        for name, help_text in (
+                ('count', 'Число запросов к СА'),
+                ('errors', 'Число ошибочных запросов к СА'),
+                ('bytes_sent', 'Отправлено байт'),
+                ('bytes_received', 'Получено байт'),
+        ):
+            metric = f'ca_requests_{name}_total'
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for endpoint in snapshot['endpoints']:
+                lines.append(
+                    f'{metric}{{method="{endpoint["method"]}",'
+                    f'endpoint="{endpoint["endpoint"]}"}} {endpoint[name]}'
+                )
+        metric = 'ca_request_latency_seconds'
+        lines.append(f'# HELP {metric} Задержка запросов к СА')
+        lines.append(f'# TYPE {metric} histogram')
+        for endpoint in snapshot['endpoints']:
+            labels = f'method="{endpoint["method"]}",' \
+                     f'endpoint="{endpoint["endpoint"]}"'
+            cumulative = 0
+            bounds = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+            for bound, count in zip(bounds, endpoint['latency_buckets']):
+                cumulative += count
+                lines.append(
+                    f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{metric}_sum{{{labels}}} {endpoint["latency_sum"]}')
+            lines.append(f'{metric}_count{{{labels}}} {endpoint["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # формат выбирается по расширению: .prom -- Prometheus, иначе JSON
+        with open(path, 'w', encoding='utf-8') as output_file:
+            if path.endswith('.prom'):
+                output_file.write(self.to_prometheus())
+            else:
+                output_file.write(self.to_json())
+
+
+@contextmanager
+def measure_phase(metrics, name):
+    requests_before = metrics.total_requests()
+    started = perf_counter()
+    yield
+    seconds = perf_counter() - started
+    requests = metrics.total_requests() - requests_before
+    metrics.record_phase(name, seconds, requests)
+    tqdm.write(
+        f'{name}: {seconds:.1f} с, запросов {requests}, '
+        f'{requests / seconds if seconds else 0:.1f} запросов/с'
+    )
@@ -0,0 +1,39 @@
+from threading import Lock, local
+
+__all__ = [
+    'CARestSessionPool',
+]
+
+
+class CARestSessionPool(object):
+    """
+    Пул сессий CARest: каждый поток получает свою залогиненную сессию,
+    созданную через session_factory, все сессии закрываются при выходе.
+    """
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        self._local = local()
+        self._lock = Lock()
+        self._sessions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._session_factory()
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.__exit__(None, None, None)
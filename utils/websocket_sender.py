@@ -0,0 +1,117 @@
+import json
+import ssl
+from queue import Empty, Queue
+from threading import Thread
+from time import sleep
+
+from websocket import WebSocketException, create_connection
+
+from base.base import Base
+
+__all__ = [
+    'WebsocketSender',
+]
+
+_STOP = object()
+
+
+class WebsocketSender(Base):
+    """
+    Одно долгоживущее websocket-соединение с СА. Сообщения ставятся в
+    очередь и отправляются из фонового потока, несколько сообщений
+    подряд склеиваются в один CYBER_ASSISTANT_CLIENT_SOCKET_MESSAGE.
+    При обрыве соединение переоткрывается. Колбэк on_sent сообщения
+    вызывается из фонового потока только после успешной отправки.
+    """
+    MAX_BATCH = 100
+    FLUSH_INTERVAL = 0.05
+    RECONNECT_ATTEMPTS = 5
+    RECONNECT_DELAY = 1
+
+    def __init__(self, url, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._url = url
+        self._queue = Queue()
+        self._thread = None
+        self._ws = None
+
+    def send(self, data, on_sent=None):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((data, on_sent))
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        self._disconnect()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            # ждем немного, чтобы собрать в пачку соседние сообщения
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    item = self._queue.get(timeout=self.FLUSH_INTERVAL)
+                except Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        message = json.dumps(
+            {
+                "type": "CYBER_ASSISTANT_CLIENT_SOCKET_MESSAGE",
+                "data": [data for data, _ in batch]
+            }
+        )
+        for attempt in range(self.RECONNECT_ATTEMPTS):
+            try:
+                if self._ws is None:
+                    self._ws = create_connection(
+                        self._url,
+                        sslopt={'cert_reqs': ssl.CERT_NONE}
+                    )
+                self._ws.send(message)
+                break
+            except (WebSocketException, OSError) as error:
+                self._logger.warning(
+                    'Ошибка отправки websocket-сообщения '
+                    '(попытка {}): {!r}'.format(attempt + 1, error)
+                )
+                self._disconnect()
+                sleep(self.RECONNECT_DELAY)
+        else:
+            self._logger.error(
+                'Не удалось отправить {} websocket-сообщений'.format(
+                    len(batch)
+                )
+            )
+            return
+        for _, on_sent in batch:
+            if on_sent is None:
+                continue
+            try:
+                on_sent()
+            except Exception as error:
+                self._logger.error(
+                    'Ошибка обработки отправленного websocket-сообщения: '
+                    '{!r}'.format(error)
+                )
+
+    def _disconnect(self):
+        if self._ws is not None:
+            try:
+                self._ws.close()
+            except (WebSocketException, OSError):
+                pass
+            self._ws = None
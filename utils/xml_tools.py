@@ -1,21 +1,68 @@
 def get_text_value(tree, key):
-    if tree.find(key) is None:
+    element = tree.find(key)
+    if element is None or element.text is None:
         return
-    if tree.find(key).text is None:
-        return
-    return tree.find(key).text.replace('&quot;', '\"')
+    return element.text.replace('&quot;', '\"')
 
 
 def get_float_value(tree, key):
-    if tree.find(key) is None:
+    element = tree.find(key)
+    if element is None:
         return 0
-    return float(tree.find(key).text.replace('.', '').replace(',', '.'))
+    return float(element.text.replace('.', '').replace(',', '.'))
 
 
 def get_float_value_with_dot(tree, key):
-    if tree.find(key) is None:
+    element = tree.find(key)
+    if element is None:
         return 0
-    if tree.find(key).text[-1] == '-':
-        return -float(tree.find(key).text[:-1])
+    if element.text[-1] == '-':
+        return -float(element.text[:-1])
     else:
-        return float(tree.find(key).text)
+        return float(element.text)
+
+
+def _signed(text):
+    # в выгрузках SAP минус у отрицательных чисел стоит в конце: 1.5-
+    if text and text[-1] == '-':
+        return '-' + text[:-1]
+    return text
+
+
+class ElementFields(dict):
+    """
+    Поля элемента {тег потомка: текст} за один проход по потомкам.
+    Как и find, для повторяющегося тега берется первый потомок.
+    Для отсутствующего поля text возвращает None, числовые -- 0.
+    Без tree создается пустым, поля заполняет потоковый разбор.
+    """
+
+    def __init__(self, tree=()):
+        super().__init__()
+        for child in tree:
+            if child.tag not in self:
+                self[child.tag] = child.text
+
+    def text(self, key):
+        value = self.get(key)
+        if value is None:
+            return
+        return value.replace('&quot;', '\"')
+
+    def sap_float(self, key):
+        # 1.234,5 -- точка разделяет разряды, запятая -- дробную часть
+        if key not in self:
+            return 0
+        value = self[key]
+        if value is None:
+            raise ValueError(f'Пустое числовое поле {key}')
+        return float(_signed(value).replace('.', '').replace(',', '.'))
+
+    def float_with_dot(self, key):
+        # 1234.5 или 1234.5-
+        if key not in self:
+            return 0
+        value = self[key]
+        if value is None:
+            raise ValueError(f'Пустое числовое поле {key}')
+        return float(_signed(value))